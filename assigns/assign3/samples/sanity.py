@@ -1,19 +1,22 @@
 #!/usr/bin/python
 import re, string, random
 
+WORKER_CPU = re.compile(r'Worker (\d+) is set to run on CPU (\d+).')
+CHILD_TIME = re.compile(r'([^:]*): (\d+)([^:]*): ([0-9]+\.[0-9e\-]+) .*')
+
 # Normalize factor-farm output
 def normalize_farm_output_lines(str):
     normalized_lines = []
     pids = {}
     for line in str.split('\n'):
-        match = re.match(r'Worker (\d+) is set to run on CPU (\d+).', line)
+        match = WORKER_CPU.match(line)
         if match:
             pid = int(match.group(1))
             if pid not in pids: pids[pid] = 'pid-%d' % len(pids)
             normalized_pid = pids[pid]
             cpu = int(match.group(2))
             line = 'Worker %s is set to run on CPU %d.' % (normalized_pid, cpu)
-        match = re.match(r'([^:]*): (\d+)([^:]*): ([0-9]+\.[0-9e\-]+) .*', line)
+        match = CHILD_TIME.match(line)
         if match:
             pid = int(match.group(2))
             normalized_pid = 'child-pid' if pid in pids else 'unrelated-pid'
@@ -21,82 +24,40 @@ def normalize_farm_output_lines(str):
         normalized_lines.append(line)
     return '\n'.join(normalized_lines)
 
-def handle_specific_system_call(line):
-    match = re.search(r'arch_prctl.*', line)
-    if match:
-        return 'arch_prctl -> [signature-not-available]'
-    match = re.search(r'syscall\(2\).*', line)
-    if match:
-        return 'syscall(2) = <fd>'
-    match = re.search(r'syscall\(39\).*', line)
-    if match:
-        return 'syscall(39) = <pid>'
-    match = re.search(r'syscall\(56\).*', line)
-    if match:
-        return 'syscall(56) = <tid>'
-    match = re.search(r'syscall\(110\).*', line)
-    if match:
-        return 'syscall(110) = <pid>'
-    match = re.search(r'syscall\(186\).*', line)
-    if match:
-        return 'syscall(186) = <tid>'
-    match = re.search(r'syscall\(231\).*', line)
-    if match:
-        return 'syscall(231) = <no return>'
-    match = re.search(r'getpid\(\).*', line)
-    if match:
-        return 'getpid() = <pid>'
-    match = re.search(r'getppid\(\).*', line)
-    if match:
-        return 'getppid() = <pid>'
-    match = re.search(r'gettid\(\).*', line)
-    if match:
-        return 'gettid() = <tid>'
-    match = re.search(r'brk[^=]+ (= [xa-fA-F0-9]+)', line)
-    if match:
-        line = line.replace(match.group(1), '= <brk-return-address>')
-    match = re.search(r'clone[^=]+ (= [0-9]+)', line)
-    if match:
-        line = line.replace(match.group(1), '= <tid>')
-    match = re.search(r'open\([^)]+\) (= \d+)', line)
-    if match:
-        line = line.replace(match.group(1), '= <fd>')
-    match = re.search(r'fstat(\(\d+,).*', line)
-    if match:
-        line = line.replace(match.group(1), '(<fd>,')
-    match = re.search(r'read(\(\d+,).*', line)
-    if match:
-        line = line.replace(match.group(1), '(<fd>,')
-    match = re.search(r'write(\(\d+,).*', line)
-    if match:
-        line = line.replace(match.group(1), '(<fd>,')
-    match = re.search(r'close\((\d+)\).*', line)
-    if match:
-        line = line.replace(match.group(1), '<fd>')
-    match = re.search(r'(mmap\([^,]+, [^,]+, [^,]+, [^,]+,)( [^,]+,)( [^)]+\).*)', line)
-    if match:
-        line = match.group(1) + ' <fd>,' + match.group(3)
-    return line
+def replacing_group(text):
+    # rule action: every occurrence of what group 1 matched is replaced by text
+    return lambda match, line: line.replace(match.group(1), text)
+
+# trace output specifics that vary run to run (fds, pids, addresses) replaced by placeholders
+# LineFilter (see testing) skips each rule with a substring test unless its leading text is in line
+generalize_trace = LineFilter(
+    ("line", [(r'arch_prctl', 'arch_prctl -> [signature-not-available]'),
+              (r'syscall\(2\)', 'syscall(2) = <fd>'),
+              (r'syscall\(39\)', 'syscall(39) = <pid>'),
+              (r'syscall\(56\)', 'syscall(56) = <tid>'),
+              (r'syscall\(110\)', 'syscall(110) = <pid>'),
+              (r'syscall\(186\)', 'syscall(186) = <tid>'),
+              (r'syscall\(231\)', 'syscall(231) = <no return>'),
+              (r'getpid\(\)', 'getpid() = <pid>'),
+              (r'getppid\(\)', 'getppid() = <pid>'),
+              (r'gettid\(\)', 'gettid() = <tid>')]),
+    ("each", [(r'brk[^=]+ (= [xa-fA-F0-9]+)', replacing_group('= <brk-return-address>')),
+              (r'clone[^=]+ (= [0-9]+)', replacing_group('= <tid>')),
+              (r'open\([^)]+\) (= \d+)', replacing_group('= <fd>')),
+              (r'fstat(\(\d+,)', replacing_group('(<fd>,')),
+              (r'read(\(\d+,)', replacing_group('(<fd>,')),
+              (r'write(\(\d+,)', replacing_group('(<fd>,')),
+              (r'close\((\d+)\)', replacing_group('<fd>')),
+              (r'(mmap\([^,]+, [^,]+, [^,]+, [^,]+,)( [^,]+,)( [^)]+\).*)', lambda match, line: match.group(1) + ' <fd>,' + match.group(3))]),
+    # repeat (not all): each address/number found is replaced wherever its text occurs, also as prefix of a longer
+    # one, e.g. 'num 1234567 and 12345678' -> 'num <large-number> and <large-number>8', as sample output was made
+    ("repeat", [(r'0x[0-9a-fA-F]{5,16}', '<userspace-address>'),
+                (r'\-?\d{6,16}', '<large-number>')]))
 
 def generalize_line(line):
-    line = handle_specific_system_call(line)
-    while True:
-        match = re.search(r'0x[0-9a-fA-F]{5,16}', line)
-        if not match: break
-        line = line.replace(match.group(0), '<userspace-address>')
-    while True:
-        match = re.search(r'\-?\d{6,16}', line)
-        if not match: break
-        line = line.replace(match.group(0), '<large-number>')
-    return line
+    return generalize_trace.filter_line(line)
 
-def normalize_trace_output_lines(str):
-    normalized_lines = []
-    lines = str.split('\n')
-    for line in lines:
-        line = generalize_line(line)
-        normalized_lines.append(line)
-    return '\n'.join(normalized_lines)
+normalize_trace_output_lines = generalize_trace
 
 def strip_all_but_syscall_name(str):
     normalized_lines = []
@@ -3,11 +3,11 @@
 Julie Zelenski, 2016-present
 
 Table of test/sunet results, used by dryrun
-Read/write to pickled cache file
+Read/write to sqlite cache file (one row per test/sunet, so updates and lookups touch only the rows involved)
 Goal is fairly simple, but code is decidedly unpleasing as currently written, ugh
 """
 
-import collections, cPickle, os
+import collections, cPickle, os, sqlite3
 import gen, results, ui, util
 
 
@@ -16,10 +16,12 @@ class Missing(results.Result):
     onechar = '@'; short = "Missing from dryrun cache"; score = '---'
 
 # overview:
-# dryrun cache file is a pickled dict
-# cache[TIPS][sunet] = tip revision
-# cache[testname][sunet] = result of running test on sunet's repo
+# dryrun cache file is sqlite database (WAL mode, so concurrent dryruns don't clobber each other)
+# table tips: sunet -> tip revision
+# table results: (testname, sunet) -> pickled result of running test on sunet's repo
 # testname is string from manifest
+# earlier versions used a pickled dict, cache[TIPS][sunet] = tip, cache[testname][sunet] = result
+# found at the old path, it is imported into the database and moved aside
 
 TIPS = "_TIPS"
 class Aggregate(object):
@@ -30,29 +32,42 @@ class Aggregate(object):
         self.all_results = collections.defaultdict(dict)  # dict organized [testname][sunet] = result
         self.updated = []  # queue of tuple(testname, sunet, result) to be added to cache
         self.tips = {}  # dict organized [sunet] = tip revision
-
-    def read_cache(self):
+        self.db = None
+
+    def connect(self):
+        if self.db is None:
+            util.system("mkdir -p %s" % os.path.dirname(self.path))
+            self.db = sqlite3.connect(self.path + ".sqlite", timeout=60)  # waits out other dryrun's write
+            self.db.text_factory = str
+            self.db.execute("PRAGMA journal_mode=WAL")
+            with self.db:
+                self.db.execute("CREATE TABLE IF NOT EXISTS tips (sunet TEXT PRIMARY KEY, rev TEXT)")
+                self.db.execute("CREATE TABLE IF NOT EXISTS results (testname TEXT, sunet TEXT, result BLOB, PRIMARY KEY (testname, sunet))")
+            self.import_pickle()
+        return self.db
+
+    def import_pickle(self):
+        """One-time migration of old pickled cache into database"""
+        if not os.path.exists(self.path): return
+        if self.db.execute("SELECT 1 FROM results LIMIT 1").fetchone(): return  # already migrated (old one couldn't be moved aside?)
         try:
-            if os.path.exists(self.path):
-                with open(self.path, "r") as fp:
-                    return cPickle.load(fp)
+            with open(self.path, "r") as fp:
+                pickled = cPickle.load(fp)
+            with self.db:
+                self.db.executemany("INSERT OR REPLACE INTO tips VALUES (?, ?)", pickled.pop(TIPS, {}).items())
+                self.db.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?)", ((tname, sunet, dump_result(r))
+                                    for (tname, tsunets) in pickled.items() for (sunet, r) in tsunets.items()))
         except Exception:
             print ui.red("failed to read pickle file %s, moving aside." % self.path)
-            util.archive_file(self.path)
-        return {}
-
-    def write_cache(self, dict_to_save):
-        util.system("mkdir -p %s" % os.path.dirname(self.path))
-        with open(self.path, "w") as fp:
-            cPickle.dump(dict_to_save, fp)
+        util.archive_file(self.path)
 
     def commit_updates(self):
-        pickled = self.read_cache()
-        for (testname, sunet, result) in self.updated:
-            if testname not in pickled: pickled[testname] = {}
-            if result.__class__ == results.NoExecute: continue
-            pickled[testname][sunet] = result
-        self.write_cache(pickled)
+        rows = [(testname, sunet, dump_result(result)) for (testname, sunet, result) in self.updated
+                if testname != TIPS and result.__class__ != results.NoExecute]
+        tips = [(sunet, tiprev) for (testname, sunet, tiprev) in self.updated if testname == TIPS]
+        with self.connect():  # one transaction
+            self.db.executemany("INSERT OR REPLACE INTO tips VALUES (?, ?)", tips)
+            self.db.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?)", rows)
         self.updated = []  # reset queue to empty
 
     def num_updates(self):
@@ -68,29 +83,26 @@ class Aggregate(object):
         return self.all_results[testname].get(sunet, None)
 
     def find_and_remove_stale(self, tnames_in_manifest, repos):
-        pickled = self.read_cache()
-        stale_tests = [t for t in pickled if t != TIPS and t not in tnames_in_manifest]
-        for t in stale_tests:
-            del pickled[t]
-        tips = pickled.get(TIPS, {})  # use empty dict if no tip revisions cached
+        db = self.connect()
+        stale_tests = [t for (t,) in db.execute("SELECT DISTINCT testname FROM results") if t not in tnames_in_manifest]
+        tips = dict(db.execute("SELECT sunet, rev FROM tips"))
         stale_sunets = set(r.sunet for r in repos if r.sunet in tips and tips[r.sunet] != r.grading_head)
-        for (tname, tsunets) in pickled.items():
-            for s in (stale_sunets & tsunets.viewkeys()):  # intersect stale with cached
-                del tsunets[s]
-        self.write_cache(pickled)
+        with db:
+            db.executemany("DELETE FROM results WHERE testname = ?", [(t,) for t in stale_tests])
+            db.executemany("DELETE FROM results WHERE sunet = ?", [(s,) for s in stale_sunets])
+            db.executemany("DELETE FROM tips WHERE sunet = ?", [(s,) for s in stale_sunets])
         return (stale_tests, stale_sunets)
 
     def select_from_cache(self, tests, repos):
         '''loads table with test/sunet results read from cache'''
         self.all_results = collections.defaultdict(dict)
-        pickled = self.read_cache()
-        self.tips = pickled.get(TIPS, {})  # save tips, keep separate from dict of results
+        db = self.connect()
         sunets_to_extract = set(r.sunet for r in repos)
+        self.tips = dict((s, rev) for (s, rev) in db.execute("SELECT sunet, rev FROM tips") if s in sunets_to_extract)
         for t in tests:
-            cached_for_test = pickled.get(t.name, {})  # use empty dict if no cache entry for test
-            # find intersection between selected sunets and those sunets with cached result for this test
-            found_sunets = set(sunets_to_extract & cached_for_test.viewkeys())
-            if found_sunets: self.all_results[t.name] = dict((s, cached_for_test[s]) for s in found_sunets)
+            # only unpickle results for selected sunets with cached result for this test
+            found = [(s, r) for (s, r) in db.execute("SELECT sunet, result FROM results WHERE testname = ?", (t.name,)) if s in sunets_to_extract]
+            if found: self.all_results[t.name] = dict((s, cPickle.loads(str(r))) for (s, r) in found)
 
     def summarize_one_sunet(self, sunet, testnames):
         row_results = [self.all_results[tname][sunet] if sunet in self.all_results[tname] else Missing() for tname in testnames]
@@ -131,3 +143,6 @@ class Aggregate(object):
         classes = [cls for cls in results.Result.__subclasses__() if cls in used]
         rows = [self.summarize_one_test(tname, classes) for tname in sorted(self.all_results.keys())]
         return util.Struct(rows=rows, cols=[cls.__name__ for cls in classes])
+
+def dump_result(result):
+    return sqlite3.Binary(cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL))
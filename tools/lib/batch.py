@@ -0,0 +1,221 @@
+
+"""
+Batch pregrade of an assignment's worth of submissions
+
+Every (repo, test) pair is a job, jobs are spread across a worker pool so the whole class
+is graded concurrently instead of one repo at a time. Within a repo, a barrier test (BuildClean)
+still runs alone with tests before/after it waiting their turn. Results are saved from the
+main thread only, via the usual Submission.save_test_result.
+The queue of jobs is kept on disk (PRIVATE_DATA_PATH/batch), so an interrupted run picks up
+where it left off when re-run.
+"""
+
+import collections, copy, cPickle, os
+import gen, grading, results, testing, ui, util, workspace
+from repos import Repo
+
+
+class BatchQueue(object):
+    """Persistent list of jobs (sunet, testname) for one assignment. The full list is written once,
+    then each completed job is appended to a done log, remaining = list minus done"""
+
+    def __init__(self, reponame):
+        base = os.path.join(gen.PRIVATE_DATA_PATH, "batch", reponame)
+        self.path = base + ".queue"
+        self.done_path = base + ".done"
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def create(self, jobs):
+        if not os.path.exists(os.path.dirname(self.path)): os.makedirs(os.path.dirname(self.path))
+        tmpfile = self.path + "~"
+        with open(tmpfile, "w") as fp:
+            cPickle.dump(jobs, fp)
+        util.remove_files(self.done_path)
+        os.rename(tmpfile, self.path)  # atomic save, just in case
+
+    def remaining(self):
+        with open(self.path, "r") as fp:
+            jobs = cPickle.load(fp)
+        done = set(tuple(line.split()) for line in (util.read_file(self.done_path) or "").splitlines())
+        return [j for j in jobs if j not in done]
+
+    def mark_done(self, job):
+        util.append_to_file("%s %s\n" % job, self.done_path)
+
+    def remove(self):
+        util.remove_files(self.path, self.done_path)
+
+
+class BatchProgress(object):
+    """Overprinted one-line status: count done, elapsed, estimated time remaining, what is running"""
+
+    def __init__(self, total):
+        self.total = total
+        self.done = 0
+        self.start = util.monotonic()
+
+    def show(self, running):
+        elapsed = util.monotonic() - self.start
+        eta = "%s" % nice_seconds(elapsed / self.done * (self.total - self.done)) if self.done else "?"
+        status = "[%d/%d] %s elapsed, %s to go" % (self.done, self.total, nice_seconds(elapsed), eta)
+        if running: status += " (%s)" % ", ".join(sorted(running))
+        ui.overprint(status[:150])
+
+def nice_seconds(secs):
+    return "%d:%02d:%02d" % (secs // 3600, secs % 3600 // 60, secs % 60)
+
+
+class RepoJobs(object):
+    """Tests still to run on one repo, in manifest order. A barrier test starts only when nothing
+    else on this repo is running, and nothing after it starts until it finishes. A test starts once
+    the tests it requires have finished, and is skipped if one of them did not pass.
+    Other tests on the repo run concurrently, each in own workspace cloned from a snapshot
+    of the repo brought up to date after the last barrier"""
+
+    def __init__(self, repo, tests):
+        self.repo = repo
+        self.pending = collections.deque(tests)
+        self.unfinished = set(t.name for t in tests)
+        self.running = 0
+        self.barrier_running = False
+        self.spaces = None
+        self.fresh = False  # whether spaces has been brought up to date since last barrier
+
+    def next_ready(self):
+        """Returns tuple (test, workspaces to run in or None to run in repo, Skipped result or None) for
+        next test ready to go, None if none ready. Caller reports skipped test as finished without running it"""
+        if self.barrier_running: return None
+        for t in self.pending:
+            if t.is_barrier:
+                if self.running or t is not self.pending[0]: return None  # barrier waits for all before it, none pass it
+                break
+            if not any(r in self.unfinished for r in t.requirements()): break
+        else:
+            return None
+        self.pending.remove(t)
+        self.running += 1
+        unmet = testing.unmet_requirement(t, self.repo.sub.testresults)  # results of this batch and any earlier grading
+        if unmet: return (t, None, testing.skipped(t, unmet))
+        self.barrier_running = t.is_barrier
+        if t.is_barrier:
+            self.fresh = False  # barrier may change repo (e.g. build), refresh snapshot after
+        elif t.can_isolate and not self.spaces:
+            self.spaces = workspace.Workspaces(self.repo.path)
+            self.fresh = True
+        elif t.can_isolate and not self.fresh:
+            self.spaces.refresh()
+            self.fresh = True
+        return (t, self.spaces if t.can_isolate else None, None)
+
+    def discard_workspaces(self):
+        if self.spaces: self.spaces.cleanup()
+        self.spaces = None
+
+    def finished(self, t):
+        self.unfinished.discard(t.name)
+        self.running -= 1
+        self.barrier_running = False
+
+    def is_complete(self):
+        return not self.pending and not self.running
+
+
+def needed_tests(repo, tests, update):
+    """Readies repo for grading, returns which of tests need to run (all if update, else those with no previous result)"""
+    repo.start_grading()
+    grading.verify_repo_ready_for_grading(repo, False, confirm=False)
+    return [t for t in tests if update or not repo.sub.cached_result_for(t)]
+
+def run_job(key, test, repo, spaces):
+    # each job works on own copy of test, test objects hold per-run state (e.g. cached solution, timeout)
+    # commands run under job key, so that if abandoned, testing.cancel_job(key) kills them
+    with testing.job_scope(key):
+        if spaces: return testing.run_isolated(copy.copy(test), spaces, testing.FOR_PREGRADE, repo)
+        return copy.copy(test).run(repo.path, testing.FOR_PREGRADE, noisy=False, repo=repo)
+
+def batch_pregrade(reponame, sunets, tests, update=False, jobs=4, job_timeout=None, restart=False):
+    """Pregrade the tests on the repos for sunets. Any unfinished queue from an earlier interrupted run
+    for this assignment is resumed (unless restart). A job taking longer than job_timeout seconds is
+    abandoned (its commands killed) and recorded as Deferred"""
+    queue = BatchQueue(reponame)
+    resuming = queue.exists() and not restart
+    if not resuming:
+        joblist = []
+        for sunet in sunets:
+            ui.overprint("Preparing %s/%s" % (reponame, sunet))
+            joblist += [(sunet, t.name) for t in needed_tests(Repo(reponame, sunet), tests, update)]
+        ui.overprint('')
+        queue.create(joblist)
+    remaining = queue.remaining()
+    if resuming: print "Resuming interrupted batch pregrade for %s, %d jobs remain" % (reponame, len(remaining))
+
+    by_name = dict((t.name, t) for t in tests)
+    todo = collections.OrderedDict()  # sunet -> list of tests, in order of queue
+    for (sunet, testname) in remaining:
+        if testname not in by_name: continue  # test no longer in manifest, nothing to do
+        todo.setdefault(sunet, []).append(by_name[testname])
+    work = collections.OrderedDict()  # sunet -> RepoJobs
+    for sunet in todo:
+        repo = Repo(reponame, sunet)
+        repo.start_grading()
+        work[sunet] = RepoJobs(repo, todo[sunet])
+
+    pool = util.WorkerPool(jobs)
+    progress = BatchProgress(sum(len(rj.pending) for rj in work.values()))
+    started = {}  # key -> (start time, sunet, test) for jobs in pool
+    nextkey = 0
+    try:
+        while work:
+            # fill pool, taking from earliest repos first (keeps few repos in flight at once)
+            for sunet in work.keys():
+                while len(started) < jobs and sunet in work:
+                    ready = work[sunet].next_ready()
+                    if ready is None: break
+                    (t, spaces, skip) = ready
+                    if skip:
+                        record_result(sunet, t, skip, work, queue, progress)
+                        continue
+                    pool.submit(nextkey, run_job, nextkey, t, work[sunet].repo, spaces)
+                    started[nextkey] = (util.monotonic(), sunet, t)
+                    nextkey += 1
+            progress.show(["%s:%s" % (s, t.name) for (when, s, t) in started.values()])
+            outcome = pool.next_finished(timeout=1)
+            if outcome:
+                (key, result, exc_info) = outcome
+                if exc_info:  # report, but don't let one bad repo halt the batch
+                    ui.overprint('')
+                    print ui.red("%s on %s/%s raised %s: %s" % (started[key][2].name, reponame, started[key][1], exc_info[0].__name__, exc_info[1]))
+                    result = results.Deferred()
+                (when, sunet, t) = started.pop(key)
+                record_result(sunet, t, result, work, queue, progress)
+            if job_timeout:
+                for key in [k for k in started if util.monotonic() - started[k][0] > job_timeout]:
+                    pool.abandon(key)
+                    testing.cancel_job(key)  # kill its commands, frees the worker
+                    result = results.Deferred(short="Deferred (batch job did not finish within %g seconds)" % job_timeout)
+                    (when, sunet, t) = started.pop(key)
+                    record_result(sunet, t, result, work, queue, progress)
+    except KeyboardInterrupt:
+        for key in started: testing.cancel_job(key)  # kill commands of running jobs, else shutdown waits them out
+        for rj in work.values(): rj.discard_workspaces()
+        ui.overprint('')
+        print ui.red("Batch interrupted, %d jobs remain. Re-run to resume." % (progress.total - progress.done))
+        raise
+    finally:
+        pool.shutdown()
+    ui.overprint('')
+    queue.remove()
+    print "Batch pregrade of %d jobs for %s completed in %s" % (progress.done, reponame, nice_seconds(util.monotonic() - progress.start))
+
+def record_result(sunet, t, result, work, queue, progress):
+    rj = work[sunet]
+    result.set_test(t)
+    rj.repo.sub.save_test_result(t.name, result)
+    queue.mark_done((sunet, t.name))
+    rj.finished(t)
+    if rj.is_complete():
+        rj.discard_workspaces()
+        del work[sunet]
+    progress.done += 1
@@ -0,0 +1,183 @@
+
+"""
+Content-addressed store for outcomes of deterministic executions (e.g. solution output)
+Entries are keyed by digest of everything that determines the outcome (executable contents,
+expanded command, input files, ...), so a stale entry is never found, instead of having to be
+detected by comparing timestamps. Each entry is its own pickle file, written to a temp file
+and renamed into place, so concurrent writers never produce or observe a partial entry.
+"""
+
+import cPickle, errno, hashlib, os, re, shutil, stat, tempfile, threading, time, zlib
+
+CHUNK_SIZE = 64*1024
+FILE_SUFFIX = ".data"  # file entries (put_file) are stored alongside pickled entries under key + suffix
+_memo = {}    # path -> (stat signature, hexdigest), avoids re-reading unchanged files
+_memo_lock = threading.Lock()
+
+def file_digest(path):
+    """sha1 hexdigest of file contents, memoized on (mtime, size, inode) so an unchanged file is read only once"""
+    st = os.stat(path)
+    sig = (st.st_mtime, st.st_size, st.st_ino)
+    with _memo_lock:
+        memo = _memo.get(path)
+    if memo and memo[0] == sig: return memo[1]
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), ""):
+            h.update(chunk)
+    with _memo_lock:
+        _memo[path] = (sig, h.hexdigest())
+    return h.hexdigest()
+
+def path_digest(path):
+    """Digest of regular file, or of directory (names + digests of the regular files directly inside it,
+    not recursive). Returns None for anything else (missing, device, etc.)"""
+    try:
+        mode = os.stat(path).st_mode
+        if stat.S_ISREG(mode):
+            return file_digest(path)
+        if stat.S_ISDIR(mode):
+            entries = sorted(os.listdir(path))
+            files = [name for name in entries if os.path.isfile(os.path.join(path, name))]
+            return key_for(*(entries + [file_digest(os.path.join(path, name)) for name in files]))
+    except (IOError, OSError):
+        pass
+    return None
+
+def private_tmpdir(name):
+    """Path of per-user directory in temp dir (name + uid), created owner-only if missing. Returns None if it
+    exists but isn't a directory owned by this user and closed to others, as then another user could plant
+    entries in it (which are unpickled when read)"""
+    path = os.path.join(tempfile.gettempdir(), "%s-%d" % (name, os.getuid()))
+    try:
+        os.mkdir(path, 0700)
+    except OSError as ex:
+        if ex.errno != errno.EEXIST: return None
+    try:
+        st = os.lstat(path)  # lstat, symlink to somewhere else doesn't qualify
+    except OSError:
+        return None
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0077: return None
+    return path
+
+KEY_REGEX = re.compile(r"[0-9a-f]{40}")
+
+def hex_keys(data):
+    """Set of every string in data that looks like a key (40 hex digits, as sha1 hexdigest), used to find what
+    pickled data refers to without unpickling it (pickle keeps short strings as is)"""
+    return set(KEY_REGEX.findall(data))
+
+def key_for(*parts):
+    """Combine string parts into a single hex key (length-prefixed, so parts can't run together ambiguously)"""
+    h = hashlib.sha1()
+    for p in parts:
+        p = str(p)
+        h.update("%d:%s" % (len(p), p))
+    return h.hexdigest()
+
+
+class DigestStore(object):
+    """Maps key (from key_for) to pickled value, one file per key under dirpath.
+    If fallback dirpath given, reads check both, and writes go there when dirpath not writable
+    (e.g. shared course directory not writable by student running sanity check). Fallback should
+    be private to the user (see private_tmpdir), entries are unpickled when read"""
+
+    def __init__(self, dirpath, fallback=None):
+        self.dirs = [dirpath] + ([fallback] if fallback else [])
+
+    def _path(self, dirpath, key):
+        return os.path.join(dirpath, key[:2], key)
+
+    def get(self, key):
+        for d in self.dirs:
+            try:
+                with open(self._path(d, key), "rb") as f:
+                    return cPickle.load(f)
+            except (IOError, OSError, EOFError, cPickle.UnpicklingError):
+                pass   # missing or unreadable entry, treat as absent
+        return None
+
+    def put(self, key, value):
+        """Atomically write entry (temp file + rename), returns True if stored in any location"""
+        data = cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+        return self._store(key, lambda f: f.write(data)) is not None
+
+    def get_path(self, key):
+        """Path to file entry stored with put_file, None if no such entry"""
+        for d in self.dirs:
+            path = self._path(d, key) + FILE_SUFFIX
+            if os.path.isfile(path): return path
+        return None
+
+    def put_file(self, key, srcpath):
+        """Copy file at srcpath in as file entry for key (for data too large to pickle, e.g. spooled output),
+        returns path of entry, None if could not be stored"""
+        def copy_from_src(f):
+            with open(srcpath, "rb") as src:  # opened per attempt, each location gets a full copy
+                shutil.copyfileobj(src, f, CHUNK_SIZE)
+        return self._store(key, copy_from_src, FILE_SUFFIX)
+
+    def _store(self, key, write, suffix=''):
+        for d in self.dirs:
+            path = self._path(d, key) + suffix
+            tmp = None
+            try:
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError as ex:
+                    if ex.errno != errno.EEXIST: raise
+                (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+                with os.fdopen(fd, "wb") as f:
+                    write(f)
+                os.chmod(tmp, 0644)  # mkstemp creates owner-only, entries should be readable by all
+                os.rename(tmp, path) # rename is atomic, last concurrent writer wins (all wrote same value)
+                return path
+            except (IOError, OSError):
+                if tmp and os.path.exists(tmp): os.remove(tmp)
+        return None
+
+
+class BlobStore(DigestStore):
+    """Content-addressed store of large strings (e.g. outputs kept in results), zlib compressed.
+    Key is digest of the text itself, so same text put from many places is stored once"""
+
+    def put_text(self, text):
+        """Returns key for text, None if could not be stored"""
+        if isinstance(text, unicode): text = text.encode("utf-8")
+        key = hashlib.sha1(text).hexdigest()
+        for d in self.dirs:
+            try:
+                os.utime(self._path(d, key), None)  # already have it, touched so prune sees it as just put
+                return key
+            except OSError:
+                pass
+        return key if self._store(key, lambda f: f.write(zlib.compress(text))) else None
+
+    def get_text(self, key):
+        """Returns text (str, put_text stores unicode as utf-8) stored under key, None if missing or if what is
+        stored doesn't match key (damaged entry)"""
+        for d in self.dirs:
+            try:
+                with open(self._path(d, key), "rb") as f:
+                    text = zlib.decompress(f.read())
+                if hashlib.sha1(text).hexdigest() == key: return text
+            except (IOError, OSError, zlib.error):
+                pass
+        return None
+
+    def prune(self, keep, grace):
+        """Removes entries (and leftover temp files) not in set keep and not written or touched within grace seconds,
+        returns count of entries removed. Only in first location (shared store), fallback is the user's own"""
+        cutoff = time.time() - grace
+        removed = 0
+        for (dirpath, dirnames, filenames) in os.walk(self.dirs[0]):
+            for name in filenames:
+                if name in keep or not ((len(name) == 40 and KEY_REGEX.match(name)) or name.startswith(".tmp-")): continue
+                path = os.path.join(dirpath, name)
+                try:
+                    if os.lstat(path).st_mtime >= cutoff: continue
+                    os.remove(path)
+                    if not name.startswith(".tmp-"): removed += 1
+                except OSError:
+                    pass  # gone already, or not ours to remove
+        return removed
@@ -13,4 +13,4 @@ class ManifestError(Exception):         # errors in testing/webreview manifest
     pass
 
 class ParseError(Exception):            # ConfigParser errors
-    pass
\ No newline at end of file
+    pass
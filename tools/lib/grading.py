@@ -60,19 +60,32 @@ def verify_repo_ready_for_grading(repo, has_grader_note, confirm):
         raw_input("Hit return to continue")
     return True
 
-def autograde(repo, tests_to_run, update=False):
-    """Entry point to grade a submission for context autograde"""
+def autograde(repo, tests_to_run, update=False, jobs=1):
+    """Entry point to grade a submission for context autograde
+    jobs > 1 first pregrades non-interactive tests concurrently, then grader handles whatever was deferred"""
     repo.start_grading()
     has_grader_note = os.path.exists(os.path.join(repo.path, "NOTE_TO_GRADER"))
     if not verify_repo_ready_for_grading(repo, has_grader_note, confirm=True):
         return None
+    fresh = set()  # names of tests given valid result by concurrent pregrade pass
+    if jobs > 1:
+        needed = [t for t in tests_to_run if not t.is_interactive and (update or not repo.sub.cached_result_for(t) or repo.sub.cached_result_for(t).deferred())]
+        for (t, result) in testing.run_tests(needed, repo.path, testing.FOR_PREGRADE, repo=repo, jobs=jobs):
+            repo.sub.save_test_result(t.name, result)
+            if not result.deferred(): fresh.add(t.name)
     for t in tests_to_run:
         previous = repo.sub.cached_result_for(t)
         # check for previous valid results if not updating
-        if not update and previous and not previous.deferred():
+        if (not update or t.name in fresh) and previous and not previous.deferred():
             print "  PREGRADED %-25.25s %s" % (t.name, previous.string_for_grader())
             continue  # don't re-run test, previous result is good to use
-        result = t.run(repo.path, testing.FOR_AUTOGRADER, repo=repo)
+        unmet = testing.unmet_requirement(t, repo.sub.testresults)  # as pregrade, skip if a required test did not pass
+        if unmet:
+            result = testing.skipped(t, unmet)
+            t.announce(repo.path)
+            print result.string_for_context(testing.FOR_AUTOGRADER)
+        else:
+            result = t.run(repo.path, testing.FOR_AUTOGRADER, repo=repo)
         if update and previous and result != previous:
             print ui.bold("Updated"), "(previously %s)" % previous.string_for_grader()
         repo.sub.save_test_result(t.name, result)
@@ -81,17 +94,17 @@ def autograde(repo, tests_to_run, update=False):
     if has_grader_note: handle_irregularities(repo)
     return repo
 
-def pregrade(repo, tests_to_run, update=False):
-    """Entry point to grade a submission for context pregrade"""
+def pregrade(repo, tests_to_run, update=False, jobs=1):
+    """Entry point to grade a submission for context pregrade
+    jobs > 1 runs independent tests concurrently, results still saved/reported in manifest order"""
     repo.start_grading()
     verify_repo_ready_for_grading(repo, False, confirm=False)
     orig = repo.sub.points_string()
 
-    for t in tests_to_run:
+    needed = [t for t in tests_to_run if update or not repo.sub.cached_result_for(t)]  # skip any test previously run if not updating
+    starting = lambda t: ui.overprint("Testing %s on %-25.25s" % (repo.id, t.name))
+    for (t, result) in testing.run_tests(needed, repo.path, testing.FOR_PREGRADE, repo=repo, jobs=jobs, starting=starting):
         previous = repo.sub.cached_result_for(t)
-        if not update and previous: continue  # skip any test previously run if not updating
-        ui.overprint("Testing %s on %-25.25s" % (repo.id, t.name))
-        result = t.run(repo.path, testing.FOR_PREGRADE, repo=repo)
         repo.sub.save_test_result(t.name, result)
         if update and previous and result != previous:
             print ui.bold("Updated"), "(was %s now %s)" % (previous.string_for_grader(), result.string_for_grader())
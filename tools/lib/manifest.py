@@ -59,6 +59,10 @@ def tests_for_assign(assignname, context, filters=None, predicate=lambda t: not
 
     for t in tests:
         t.validate()   # validate each test that made it through all the filters
+        # each requires must name a test that comes earlier in manifest (so order is always a valid schedule)
+        # required test may be filtered out of this run, if so, requirement is ignored
+        for req in t.requirements():
+            asserts.manifest(req in sections and req < t.name, "Test %s requires '%s', no such test found before it in manifest" % (t.name, req))
     return tests
 
 def sanity_check_exists(assignname):
@@ -95,14 +99,14 @@ def read_and_validate(reponame):
 def sanity_tests(reponame, usemaster=False):
     return tests_for_assign(reponame, testing.FOR_SANITY, usemaster=usemaster)
 
-def run_sanity_check(path, reponame, tests=None, noisy=True, usemaster=False):
-    """Runs all assignment sanity tests on submission and returns tuple (nfailures, ntests)"""
+def run_sanity_check(path, reponame, tests=None, noisy=True, usemaster=False, jobs=1):
+    """Runs all assignment sanity tests on submission and returns tuple (nfailures, ntests)
+    jobs > 1 runs independent tests concurrently, results still reported in manifest order"""
     if not tests:  # no custom tests specified, use tests from standard sanity check and exclude any Custom test if present
         tests = [t for t in sanity_tests(reponame, usemaster)]
     nfailures = 0
     sanity_results = {}
-    for test in tests:
-        result = test.run(path, testing.FOR_SANITY, noisy)
+    for (test, result) in testing.run_tests(tests, path, testing.FOR_SANITY, noisy, jobs=jobs):
         sanity_results[test.name] = result
         if not result.passed(): nfailures += 1
     return (nfailures, len(tests))
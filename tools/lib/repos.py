@@ -9,8 +9,8 @@ The "on demand" feature is done by waiting until an attribute is actually reques
 go ferret it out, but then caching it for repeated access.
 """
 
-import datetime, glob, os
-import course, gen, submits, ui, util
+import datetime, glob, os, sqlite3, time
+import course, digests, gen, submits, ui, util
 from common import *
 from pairing import Pairing
 from webreview import WebReview
@@ -228,6 +228,25 @@ class Repo(object):
         self.sub.commit_changes()  # writes iniitial GCACHE (empty)
         return self.sub
 
+    def index_signature(self):
+        """Digest of stat of every file status/grade is computed from (refs, index, GCACHE, WEB_REVIEW, ...)
+        Only stats, no git commands or unpickling, so cheap enough to check every index row against.
+        Doesn't notice edits to private working tree that haven't been added/committed (these make repo DIRTY)"""
+        public = self.public_repo_path(self.reponame, self.sunet)  # public repo is bare
+        private_git = os.path.join(self.path, ".git")
+        paths = [public] + [os.path.join(public, f) for f in ["HEAD", "packed-refs", "refs/heads/master", "refs/tags/tools/create", "refs/tags/tools/submit/latest"]] + \
+                [self.path] + [os.path.join(private_git, f) for f in ["HEAD", "index", "packed-refs", "refs/heads/grading", "refs/tags/tools/submit/latest"]] + \
+                [os.path.join(self.path, f) for f in [submits.Submission.P_FILENAME, submits.Submission.P_FILENAME + submits.Submission.J_SUFFIX,
+                                                      WebReview.REVIEW_FILENAME, "HASH_TO_GRADE"]]
+        sigs = []
+        for p in paths:
+            try:
+                st = os.stat(p)
+                sigs.append((st.st_mtime, st.st_size, st.st_ino))
+            except OSError:
+                sigs.append(None)
+        return digests.key_for(*sigs)
+
     def remove_submit_tag(self):
         util.system("find %s -type d -print0 | xargs -0 -n 1 -I FNAME fs sa FNAME %s all" % (self.public_git.path, gen.username()))
         self.public_git.git_command("tag -d tools/submit/latest")
@@ -281,6 +300,72 @@ class Repo(object):
         return concerns if len(concerns) else None
 
 
+class StatusIndex(object):
+    """Persistent table (sqlite) of status, grading head, submit time, points and buckets for every repo, so a
+    class-wide listing needn't run git commands and load GCACHE for each repo. Each row keeps Repo.index_signature
+    at time it was computed, a row whose signature no longer matches (e.g. student resubmitted, grading saved
+    results) is recomputed when listed. Nothing else writes the index, grading pays no cost for it"""
+
+    _dbs = {}  # path -> open connection, one per process
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(gen.PRIVATE_DATA_PATH, "repo_index.sqlite")
+        self.db = self._dbs.get(self.path)
+        if self.db is None:
+            try:
+                self.db = sqlite3.connect(self.path, timeout=60)
+                self.db.text_factory = str
+                self.db.execute("PRAGMA journal_mode=WAL")  # listings read while other listings refresh rows
+                with self.db:
+                    self.db.execute("""CREATE TABLE IF NOT EXISTS repos (reponame TEXT, sunet TEXT, signature TEXT, status INTEGER, grading_head TEXT,
+                                    submit_time REAL, points INTEGER, possible INTEGER, buckets TEXT, PRIMARY KEY (reponame, sunet))""")
+                self._dbs[self.path] = self.db
+            except sqlite3.Error as ex:
+                ui.warn("repo status index %s not available (%s), listing the slow way" % (self.path, ex))
+                self.db = None
+
+    def update(self, repo):
+        """Recompute repo's row (the costly way, via Repo), returns it. Failure to store row is only warned about"""
+        signature = repo.index_signature()  # before computing, a change made meanwhile leaves row stale, not wrong
+        status = repo.status
+        graded = repo.sub if status >= Repo.DIRTY else None  # None if no GCACHE yet
+        (points, possible) = graded.points_tuple() if graded else (None, None)
+        submit = repo.submit_datetime if status >= Repo.SUBMITTED else None
+        row = (repo.reponame, repo.sunet, signature, status, repo.grading_head if status >= Repo.DIRTY else None,
+               time.mktime(submit.timetuple()) if submit else None, points, possible, graded.buckets() if graded else None)
+        if self.db is not None:
+            try:
+                with self.db:
+                    self.db.execute("INSERT OR REPLACE INTO repos VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
+            except sqlite3.Error as ex:
+                ui.warn("could not update repo status index for %s (%s)" % (repo.id, ex))
+        return self.row_struct(row)
+
+    def listing(self, reponame, sunets=None):
+        """List of rows (structs with sunet, status, status_string, grading_head, submit_datetime, points, possible, buckets)
+        for repos of reponame (all if sunets is None). Rows still valid are answered from index, others are refreshed"""
+        if sunets is None: sunets = Repo.sunets_for_reponame(reponame)
+        try:
+            rows = dict((r[1], r) for r in self.db.execute("SELECT * FROM repos WHERE reponame = ?", (reponame,))) if self.db else {}
+        except sqlite3.Error as ex:
+            ui.warn("could not read repo status index (%s), listing the slow way" % ex)
+            rows = {}
+        listed = []
+        for sunet in sunets:
+            repo = Repo(reponame, sunet)
+            if sunet in rows and rows[sunet][2] == repo.index_signature():
+                listed.append(self.row_struct(rows[sunet]))
+            else:
+                listed.append(self.update(repo))
+        return listed
+
+    def row_struct(self, row):
+        (reponame, sunet, signature, status, grading_head, submit_time, points, possible, buckets) = row
+        return util.Struct(reponame=reponame, sunet=sunet, status=status, status_string=Repo.STATUS_STR[status], grading_head=grading_head,
+                           submit_datetime=datetime.datetime.fromtimestamp(submit_time) if submit_time is not None else None,
+                           points=points, possible=possible, buckets=buckets)
+
+
 # NOTES
 # we (staff group) have only rla permissions to public repo
 # this is to prevent us from any destructive operations on it
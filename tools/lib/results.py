@@ -5,21 +5,98 @@ Julie Zelenski, 2011-present
 The results module has the class hierarchy for different kinds of test results including
 various ways of displaying them (formatting for dryrun, summary report, sanity check,
 student grade report, etc. These are stored in the GCACHE pickle, so be careful about changes
-that would introduce incompatibility.
+that would introduce incompatibility. Long text fields (BlobField) are pickled as a reference into
+the blob store (PRIVATE_DATA_PATH/blobs), so loading a GCACHE doesn't drag in every output.
+Blobs no stored result refers to any more are removed by prune_blobs.
 """
 
-import operator, random
-import scoring, testing, ui, util
+import glob, operator, os, random, sqlite3
+import digests, gen, scoring, testing, ui, util
 from webreview import WebReview
 
+BLOB_MIN = 4096  # text fields at least this long are pickled as reference into blob store, not inline
+MISSING_BLOB = "(%s not available, missing from blob store)"
+BLOB_GRACE = 24*60*60  # seconds a blob is kept after last put, though no result found refers to it (yet)
+_blobs = None
+
+def blob_store():
+    global _blobs
+    if _blobs is None: _blobs = digests.BlobStore(os.path.join(gen.PRIVATE_DATA_PATH, "blobs"))
+    return _blobs
+
+def prune_blobs(grace=BLOB_GRACE):
+    """Removes blobs that no stored result refers to, returns count removed. Results are pickled in GCACHE (and its
+    journal) of each private repo and in dryrun caches, references are found by scanning those for keys, nothing
+    unpickled. A blob put within grace seconds is kept, its result may not be saved yet"""
+    keep = set()
+    for path in glob.glob(os.path.join(gen.PRIVATE_DATA_PATH, "repos", "*", "*", "GCACHE*")):
+        try:
+            with open(path, "rb") as fp:
+                keep.update(digests.hex_keys(fp.read()))
+        except (IOError, OSError):
+            return 0  # can't tell what that one refers to, don't remove anything
+    for path in glob.glob(os.path.join(gen.PRIVATE_DATA_PATH, "dryrun", "*.sqlite")):
+        try:
+            db = sqlite3.connect(path, timeout=60)
+            try:
+                for (pickled,) in db.execute("SELECT result FROM results"):
+                    keep.update(digests.hex_keys(str(pickled)))
+            finally:
+                db.close()
+        except sqlite3.Error:
+            return 0
+    return blob_store().prune(keep, grace)
+
+class BlobField(object):
+    """Descriptor for large text field of Result. When pickled (see Result.__getstate__), long value is put into
+    blob store and only its key (in field name + "_ref") is pickled, value is read back from store on first access
+    (unicode value is stored as utf-8, field name + "_encoding" is pickled too so it's decoded again).
+    If value can't be read from store (pruned, or reader has no access to PRIVATE_DATA_PATH), placeholder text
+    saying so is returned instead, the ref is kept so the value isn't lost when result is pickled again.
+    Results pickled before fields were blobbed have value inline in their dict, which is used as is"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, obj, cls):
+        if obj is None: return self
+        if self.name not in obj.__dict__:
+            ref = obj.__dict__.get(self.name + "_ref")
+            if ref is None: return None
+            text = blob_store().get_text(ref)
+            if text is None: return MISSING_BLOB % self.name  # not kept in dict, pickling still has only the ref
+            encoding = obj.__dict__.get(self.name + "_encoding")
+            obj.__dict__[self.name] = text.decode(encoding) if encoding else text
+        return obj.__dict__[self.name]
+
+    def __set__(self, obj, value):
+        obj.__dict__[self.name] = value
+        obj.__dict__.pop(self.name + "_ref", None)  # value no longer the one stored under ref
+        obj.__dict__.pop(self.name + "_encoding", None)
+
 class Result(object):
     onechar = ' '; did_pass = False; detail = ''
     score = 0
     test = None  # this struct will store essential fields copied from the Test object
+    usage = None  # struct of resource use by student run (utime, stime, maxrss, ...), None if not recorded
 
     def __init__(self, **kwds):
         """when calling ctor can set any fields of Result object using syntax ivar=value"""
-        self.__dict__.update(**kwds)
+        for (name, value) in kwds.items():
+            setattr(self, name, value)  # (goes through BlobField for those fields)
+
+    def __getstate__(self):
+        """overridden to pickle long BlobField values as reference into blob store (inline if can't be stored)"""
+        state = dict(self.__dict__)
+        for name in [n for n in dir(self.__class__) if isinstance(getattr(self.__class__, n, None), BlobField)]:
+            value = state.get(name)
+            if not isinstance(value, basestring) or len(value) < BLOB_MIN: continue
+            ref = state.get(name + "_ref") or blob_store().put_text(value)  # has ref if value was read from store
+            if ref:
+                state[name + "_ref"] = ref
+                if isinstance(value, unicode): state[name + "_encoding"] = "utf-8"  # as put_text encoded it
+                del state[name]
+        return state
 
     def passed(self):
         return self.did_pass
@@ -27,6 +104,10 @@ class Result(object):
     def deferred(self):
         return False
 
+    def satisfies_requirement(self):
+        """Whether tests that list this test in their requires should go ahead and run"""
+        return self.did_pass or self.deferred()
+
     def set_test(self, test):
         # save essential fields from Test object that produced this result, used later for reporting
         self.test = util.Struct(name=test.name, description=test.description, totalpts=test.totalpts)
@@ -109,7 +190,7 @@ class Incorrect(Result):
 
 class MismatchOutput(Result):
     onechar = 'o'; short = "Submission output does not match sample"
-    output = None; correct_output = None
+    output = BlobField("output"); correct_output = BlobField("correct_output")  # same solution output is stored once for all students
 
     def string_for_sanity(self):
         # when reporting output discrepancy for sanity, label as Mismatch, instead of definitive Not Ok
@@ -117,9 +198,7 @@ class MismatchOutput(Result):
 
     def string_for_dryrun(self):
         output = self.output if self.output else "<empty>"
-        diff = scoring.diff_ignoring_white_old(self.correct_output, output)
-        picked = "\n".join(util.grep_text("^>", diff))
-        return ui.abbreviate(picked or diff, maxlines=6)
+        return ui.abbreviate(scoring.diff_ignoring_white(self.correct_output, output, context=0), maxlines=6)
 
 class Points(Result):
     onechar = ' '; short = ''
@@ -130,11 +209,11 @@ class Points(Result):
         if not self.did_pass: self.onechar = '<'  # use < for under full-credit
 
 class TimedOut(Result):
-    onechar = 't'; short = "Waited %(limit)s seconds, program did not complete"
+    onechar = 't'; short = "Waited %(limit)g seconds, program did not complete"
 
     def summary_string(self):
         summary = self.short
-        if hasattr(self, "solntime") and self.solntime: summary += " (soln completes in under %(solntime)s seconds)"
+        if hasattr(self, "solntime") and self.solntime: summary += " (soln completes in under %(solntime)g seconds)"
         if hasattr(self, "errmsg") and self.errmsg: summary += " (error logged: %(errmsg)s)"
         return summary % self.__dict__
 
@@ -171,6 +250,9 @@ class BuildIssue(Result):
     def string_for_dryrun(self):
         return ui.abbreviate(self.detail, maxlines=3) if self.detail is not None else self.summary_string()
 
+    def satisfies_requirement(self):
+        return not self.is_error  # warnings are not a reason to hold up later tests, build error is
+
 class NoExecute(Result):
     onechar = '#'; short = "Did not execute %(msg)s"
 
@@ -229,6 +311,9 @@ class ParseWebReview(Result):
         wr = WebReview.load(self.path)
         return not wr or not wr.is_complete()
 
+class Skipped(Result):
+    onechar = '-'; short = "Not run, required test %(required)s did not pass"
+
 class Deferred(Result):
     onechar = 'D'; short = "Deferred"; score = "---"
 
@@ -247,9 +332,8 @@ def summarize_mismatch(output, correct, detail=None):
         if not scoring.match_ok(abbr_output, abbr_correct):  # if prefix shows mismatch, print both
             return "Correct output:    %c%s%c\nSubmission output: %c%s\n" % (newline, abbr_correct, newline, newline, ui.blue(abbr_output))
     # otherwise, error is deeper, use the abbreviated diff instead
-    # diffed = ui.abbreviate(scoring.diff_ignoring_white(correct, output), maxlines = 15)
-    diffed = scoring.diff_ignoring_white_old(correct, output)
-    diffed = ui.abbreviate(diffed, maxlines=50, maxlen=1000)
+    # hunks with line numbers and </> markers, detail is stored with colors stripped, highlighted diff would lose its marks
+    diffed = ui.abbreviate(scoring.diff_ignoring_white_old(correct, output), maxlines=50, maxlen=1000)
     return "Diff of correct output and submission output: \n%s\n" % ui.blue(diffed)
 
 def random_cheer(seedstr=None):
@@ -9,8 +9,9 @@ The scoring module has the functions for all varieties of scoring.
  -- Some require interaction from TA (to evaluate quality)
 """
 
-import collections, commands, difflib, math, re, signal, tempfile
-import diff_match_patch, gen, results, testing, ui, util
+import collections, cStringIO, difflib, hashlib, math, re, signal, string, sys, threading, time
+import xml.etree.cElementTree as ElementTree
+import diff_match_patch, results, testing, ui, util
 
 def half_floor(val):
     return int(math.floor(float(val)*0.5))
@@ -56,59 +57,278 @@ def summarize_execution(output, soln_output, exitcode):
         summary += " (%s)" % summarize_exit_status(exitcode)
     return summary
 
-def copy_to_temp_file(str):
-    file = tempfile.NamedTemporaryFile(mode='w', dir="/tmp")
-    file.write(str.strip())
-    file.write('\n')     # add trailing newline makes diff happy
-    file.flush()
-    # file is left open (closing will delete it, caller must close)
-    return file
+WHITE_TO_SPACE = string.maketrans("\t\r\f\v", "    ")
+
+def collapse_white(text):
+    """Each run of whitespace (other than newline) replaced by one space, as diff -b compares lines.
+    translate/replace are much faster than re.sub on large outputs, each replace pass halves the longest run"""
+    text = text.translate(WHITE_TO_SPACE)
+    while "  " in text: text = text.replace("  ", " ")
+    return text
+
+def nonblank_lines(text):
+    """Returns tuple of lists (line indexes, normalized lines) for the non-blank lines of text, as seen by diff -B -b
+    (text stripped first, as was done when written to temp file for shell diff)"""
+    (keep, keys) = ([], [])
+    for (i, line) in enumerate(collapse_white(text.strip()).split('\n')):
+        key = line.rstrip(" ")
+        if key:
+            keep.append(i)
+            keys.append(key)
+    return (keep, keys)
 
-# python difflib won't work because no option to ignore/coalese whitespace,
-# so write to files and invoke diff command at shell using -B -b flags
 def diff_ignoring_white_old(str1, str2, options=''):
-    tmp1 = copy_to_temp_file(str1)
-    tmp2 = copy_to_temp_file(str2)
-    # -T puts tabs in front of diff lines
-    result = commands.getoutput("diff -B -b -T -a %s %s %s" % (options, tmp1.name, tmp2.name))
-    tmp1.close()
-    tmp2.close()
-    return result
-
-def diff_ignoring_white(str1, str2, options=''):
-    old_version = diff_ignoring_white_old(str1, str2, options)
-    if old_version == '': return old_version
+    """In-process equivalent of shell diff -B -b -T -a (formerly forked diff on temp file copies of strings)
+    Blank lines are dropped, remaining lines compared as normalized by nonblank_lines. Returns hunks in diff's
+    normal format (line numbers refer to original lines), empty string if no differences.
+    options is accepted for compatibility with old callers, and ignored"""
+    (lines1, lines2) = (str1.strip().split('\n'), str2.strip().split('\n'))
+    ((keep1, keys1), (keep2, keys2)) = (nonblank_lines(str1), nonblank_lines(str2))
+    hunks = []
+    for (op, i1, i2, j1, j2) in line_opcodes(keys1, keys2):
+        if op == "equal": continue
+        # convert non-blank indexes to original line span, range is (first, last) 1-based, or (after, None) if empty
+        span1 = (keep1[i1] + 1, keep1[i2-1] + 1) if i2 > i1 else (keep1[i1-1] + 1 if i1 else 0, None)
+        span2 = (keep2[j1] + 1, keep2[j2-1] + 1) if j2 > j1 else (keep2[j1-1] + 1 if j1 else 0, None)
+        letter = 'c' if (i2 > i1 and j2 > j1) else ('d' if i2 > i1 else 'a')
+        hunks.append("%s%s%s" % (diff_range(*span1), letter, diff_range(*span2)))
+        if i2 > i1: hunks += ["<\t" + line for line in lines1[span1[0]-1:span1[1]]]  # -T puts tabs in front of diff lines
+        if letter == 'c': hunks.append("---")
+        if j2 > j1: hunks += [">\t" + line for line in lines2[span2[0]-1:span2[1]]]
+    return '\n'.join(hunks)
+
+LINE_DIFF_BUDGET = 1.0  # seconds allowed per line_opcodes, when used up, rest of the lines reported as one changed block
+
+def line_opcodes(lines1, lines2, budget=LINE_DIFF_BUDGET):
+    """Opcodes as SequenceMatcher.get_opcodes for two lists of lines (or tokens), from Myers diff (each distinct
+    line encoded as one char for diff_match_patch), near-linear when lists are mostly alike. SequenceMatcher is
+    quadratic on repetitive output (many equal lines), seconds for a few thousand lines"""
+    codes = {}
+    for line in lines1 + lines2: codes.setdefault(line, len(codes))
+    if len(codes) > sys.maxunicode:  # more distinct lines than chars, report all as changed
+        return [("replace", 0, len(lines1), 0, len(lines2))] if (lines1 or lines2) else []
+    (chars1, chars2) = [u"".join(unichr(codes[line]) for line in lines) for lines in (lines1, lines2)]
     dmp = diff_match_patch.diff_match_patch()
-    diffs = dmp.diff_main(str1, str2)
-    dmp.diff_cleanupSemantic(diffs)
-    return ui.pretty_diffs(dmp, diffs)
+    opcodes = []
+    (i, j, i0, j0) = (0, 0, 0, 0)  # i0, j0 start of run of changes not yet added
+    for (op, data) in dmp.diff_main(chars1, chars2, False, time.time() + budget) + [(dmp.DIFF_EQUAL, u"")]:
+        if op == dmp.DIFF_DELETE: i += len(data)
+        elif op == dmp.DIFF_INSERT: j += len(data)
+        else:
+            if (i, j) != (i0, j0):
+                tag = "replace" if (i > i0 and j > j0) else ("delete" if i > i0 else "insert")
+                opcodes.append((tag, i0, i, j0, j))
+            if data: opcodes.append(("equal", i, i + len(data), j, j + len(data)))
+            (i, j) = (i0, j0) = (i + len(data), j + len(data))
+    return opcodes
+
+def diff_range(first, last):
+    return "%d" % first if last is None or last == first else "%d,%d" % (first, last)
+
+DIFF_BUDGET = 1.0  # seconds allowed per diff_ignoring_white, when used up, changed lines shown whole
+
+def elide_unchanged(data, context, first, last):
+    """Unchanged text data between changes cut down to context lines next to each change, rest replaced by ..."""
+    lines = data.split('\n')
+    (head, tail) = (0 if first else context + 1, 0 if last else context + 1)  # +1 for partial line of change
+    if len(lines) <= head + tail + 1: return data
+    return '\n'.join(lines[:head] + ["..."] + lines[len(lines)-tail:])
+
+def diff_ignoring_white(str1, str2, options='', budget=DIFF_BUDGET, context=None):
+    """Highlighted diff for display. Diffs lines first (each line hashed to one char), then diffs chars within
+    each changed block of lines as long as budget remains. Returns empty string if no differences (ignoring white).
+    If context given, unchanged text is shown only for that many lines around each change"""
+    if normalized_digest(str1) == normalized_digest(str2): return ''
+    dmp = diff_match_patch.diff_match_patch()
+    deadline = time.time() + budget  # dmp deadlines are on time.time clock
+    try:
+        (chars1, chars2, line_array) = dmp.diff_linesToChars(str1, str2)
+        diffs = dmp.diff_main(chars1, chars2, False, deadline)
+        dmp.diff_charsToLines(diffs, line_array)
+    except ValueError:  # more distinct lines than unichr can encode, settle for char diff
+        diffs = dmp.diff_main(str1, str2, False, deadline)
+    refined = []
+    i = 0
+    while i < len(diffs):
+        (op, data) = diffs[i]
+        if op != dmp.DIFF_EQUAL and i + 1 < len(diffs) and diffs[i+1][0] == -op and time.time() < deadline:
+            (deleted, inserted) = (data, diffs[i+1][1]) if op == dmp.DIFF_DELETE else (diffs[i+1][1], data)
+            within = dmp.diff_main(deleted, inserted, False, deadline)  # on deadline, returns whole delete + insert
+            dmp.diff_cleanupSemantic(within)
+            refined += within
+            i += 2
+        else:
+            refined.append((op, data))
+            i += 1
+    if context is not None:
+        dmp.diff_cleanupMerge(refined)  # joins adjacent unchanged pieces (line diff's and within block's)
+        refined = [(op, elide_unchanged(data, context, k == 0, k == len(refined) - 1) if op == dmp.DIFF_EQUAL else data)
+                   for (k, (op, data)) in enumerate(refined)]
+    return ui.pretty_diffs(dmp, refined)
 
 def diff_test(str1, str2, options=''):
-    tmp1 = copy_to_temp_file(str1)
-    tmp2 = copy_to_temp_file(str2)
-    # -T puts tabs in front of -Blines
-    result = commands.getoutput("diff -B -b -T %s %s %s" % (options, tmp1.name, tmp2.name))
-    tmp1.close()
-    tmp2.close()
-    return result
+    return diff_ignoring_white_old(str1, str2, options)
+
+NORMALIZED_MEMO_SIZE = 64  # expected outputs kept, typically the solution outputs of the tests being run
+_normalized_memo = collections.OrderedDict()  # text -> digest of normalized text, least recently used first
+_normalized_lock = threading.Lock()
+
+def normalized_digest(text, memoize=False):
+    """Digest of text with blank lines removed and whitespace normalized, equal digests means diff -B -b
+    finds no differences. If memoize, digest is remembered (expected output is compared against over and over)"""
+    if memoize:
+        with _normalized_lock:
+            digest = _normalized_memo.pop(text, None)
+            if digest is not None:
+                _normalized_memo[text] = digest  # re-insert as most recently used
+                return digest
+    digest = hashlib.sha1('\n'.join(nonblank_lines(text)[1])).digest()
+    if memoize:
+        with _normalized_lock:
+            _normalized_memo[text] = digest
+            while len(_normalized_memo) > NORMALIZED_MEMO_SIZE:
+                _normalized_memo.popitem(last=False)
+    return digest
 
 def match_ok(output, expected_output, accept_ratio=1.0):
     """Does the output match the expected output?  Returns boolean"""
-    if diff_ignoring_white(output, expected_output) == '':
+    if output == expected_output: return True
+    # normalized digests are equal exactly when whitespace-insensitive diff is empty, no need to construct diff
+    if normalized_digest(output) == normalized_digest(expected_output, memoize=True):
         return True
-    if False and gen.JZ_RUNNING:
-        print accept_ratio
-        print ui.green(expected_output)
-        print ui.blue(output)
-        print ui.red(diff_ignoring_white(output, expected_output))
     if accept_ratio >= 1.0 or accept_ratio <= 0: return False
     # if ok to be "close", use fuzzy match algorithm
+    return fuzzy_match(output, expected_output, accept_ratio)
+
+FUZZY_CHAR_LIMIT = 1000   # longer than this, compare token sequences instead of characters
+FUZZY_EDIT_LIMIT = 1000   # outputs differing by more tokens (inserted + deleted) than this never match
+
+def fuzzy_match(output, expected_output, accept_ratio):
+    """Is similarity ratio of output to expected above accept_ratio? Cheap upper bounds on ratio are tried
+    first (length, then quick_ratio) so that most non-matches are rejected without computing ratio.
+    Long outputs are compared token by token over their whole length, ratio is 2*matches/total, so output
+    matches if it is within so many token edits of expected. Edits are counted (Myers) only as far as
+    that, and never past FUZZY_EDIT_LIMIT, which bounds the work, the same outputs always get same answer"""
     # sequence matcher has 'junk' filtering, but weird, want to ignore whitespace so remove first
     output_nowhite = output.translate(None, " \t")
     expected_nowhite = expected_output.translate(None, " \t")
-    s = difflib.SequenceMatcher(None, output_nowhite, expected_nowhite)
-    # reject above ratio
-    return s.ratio() > accept_ratio
+    if max(len(output_nowhite), len(expected_nowhite)) <= FUZZY_CHAR_LIMIT:
+        s = difflib.SequenceMatcher(None, output_nowhite, expected_nowhite)
+        # reject above ratio, each bound is more expensive and tighter than the last
+        return s.real_quick_ratio() > accept_ratio and s.quick_ratio() > accept_ratio and s.ratio() > accept_ratio
+    (seq1, seq2) = (output.split(), expected_output.split())
+    total = len(seq1) + len(seq2)
+    if not total: return True
+    # ratio is 2*matches/total, can't exceed 2*shorter/total, nor 2*(tokens in common, counted as multisets)/total
+    if 2.0 * min(len(seq1), len(seq2)) / total <= accept_ratio: return False
+    if difflib.SequenceMatcher(None, seq1, seq2, autojunk=False).quick_ratio() <= accept_ratio: return False
+    # matches = (total - edits)/2, so ratio above accept_ratio needs edits below total*(1 - accept_ratio)
+    allowed = int(math.ceil(total * (1 - accept_ratio))) - 1
+    return edit_distance(seq1, seq2, min(allowed, FUZZY_EDIT_LIMIT)) is not None
+
+def run_length(a, b, x, y):
+    """Length of run of equal items in lists a from index x and b from index y. Long runs found by
+    comparing slices of doubling length, then halving, so loop is over log of length not items"""
+    n = min(len(a) - x, len(b) - y)
+    if n <= 0 or a[x] != b[y]: return 0
+    (lo, hi) = (1, 2)  # a, b known equal for lo items
+    while hi <= n and a[x+lo:x+hi] == b[y+lo:y+hi]:
+        (lo, hi) = (hi, 2*hi)
+    hi = min(hi, n + 1)  # run is shorter than hi
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if a[x+lo:x+mid] == b[y+lo:y+mid]: lo = mid
+        else: hi = mid
+    return lo
+
+def edit_distance(a, b, limit):
+    """Fewest items deleted from a plus inserted to turn it into b (n + m - 2*longest common subsequence),
+    None if that is more than limit. Myers' greedy algorithm, work is bounded by limit (about limit**2/2
+    steps plus runs of equal items), not by the lengths of a and b"""
+    (n, m) = (len(a), len(b))
+    if abs(n - m) > limit: return None
+    v = {0: run_length(a, b, 0, 0)}  # diagonal k (x - y) -> furthest x reached on it
+    if v[0] >= n and v[0] >= m: return 0
+    for d in range(1, limit + 1):
+        # diagonals within the grid that have parity of d
+        kmin = -d if d <= m else -m + (d - m) % 2
+        kmax = d if d <= n else n - (d - n) % 2
+        for k in range(kmin, kmax + 1, 2):
+            x = v.get(k, -1)  # reached with d-2 edits, still reachable
+            if k + 1 in v and v[k+1] - k <= m: x = max(x, v[k+1])      # from k+1, inserting b[y-1]
+            if k - 1 in v and v[k-1] < n: x = max(x, v[k-1] + 1)       # from k-1, deleting a[x-1]
+            if x < 0: continue
+            x += run_length(a, b, x, x - k)
+            v[k] = x
+            if x >= n and x - k >= m: return d
+    return None
+
+STREAM_WINDOW = 1024*1024  # chars read at a time when comparing outputs from file
+
+def normalize_block(raw, strip_leading, continues_line):
+    """Normalizes run of lines as nonblank_lines does, but as one string (each line ends in newline) in a few
+    passes of regex over the whole block. continues_line if raw starts mid-line, that line is never dropped"""
+    norm = collapse_white(raw).replace(" \n", "\n")
+    while "\n\n" in norm: norm = norm.replace("\n\n", "\n")  # drop blank lines
+    if not continues_line: norm = norm.lstrip("\n")
+    return norm.lstrip(" ") if strip_leading else norm
+
+def stream_normalized(f, window=STREAM_WINDOW):
+    """Generator over open file f normalized as by normalize_block, reading window chars at a time.
+    Yields tuple (lineno, col, raw, normalized) per block, raw is the text normalized, which starts at
+    line number lineno, column col (within line as normalized). A line longer than window is split
+    across blocks. Memory use is a few windows regardless of file/line size"""
+    (lineno, col, carry) = (1, 1, '')
+    before_text = True  # nothing yielded yet, strip leading white (as str.strip of whole output)
+    for chunk in iter(lambda: f.read(window), ''):
+        carry += chunk
+        end = carry.rfind('\n') + 1
+        if not end and len(carry) > window:  # very long line, take up to its last non-white char, rest may be white at eol
+            carry = collapse_white(carry)
+            end = len(carry.rstrip(" "))
+        if not end: continue
+        (raw, carry) = (carry[:end], carry[end:])
+        norm = normalize_block(raw, before_text, col > 1)
+        if norm:
+            yield (lineno, col, raw, norm)
+            before_text = False
+        (lineno, col) = (lineno + raw.count('\n'), 1) if raw.endswith('\n') else (lineno, col + len(norm))
+    if carry or col > 1:  # last line, no newline at end of file
+        norm = normalize_block(carry + '\n', before_text, col > 1)
+        if norm: yield (lineno, col, carry + '\n', norm)
+
+def locate_in_block(block, offset):
+    """Returns tuple (line, col) for position offset within normalized text of block from stream_normalized"""
+    (lineno, col, raw, norm) = block
+    k = norm.count('\n', 0, offset)  # offset is within k'th (0-based) non-blank line of block
+    within = offset - (norm.rfind('\n', 0, offset) + 1)
+    for (i, line) in enumerate(raw.split('\n')):
+        if (i == 0 and col > 1) or line.strip(" \t\r\f\v"):
+            if k == 0: return (lineno + i, (col if i == 0 else 1) + within)
+            k -= 1
+    return (lineno, col)  # not reached
+
+def first_divergence(path1, path2, window=STREAM_WINDOW):
+    """Compares two files the way match_ok compares strings (blank lines and amount of whitespace ignored),
+    but streaming, without ever holding either file whole in memory. Returns None if they match, otherwise
+    tuple (line, col) locating first difference in file1 (col is 1-based position within line as normalized)"""
+    with open(path1) as f1:
+        with open(path2) as f2:
+            (stream1, stream2) = (stream_normalized(f1, window), stream_normalized(f2, window))
+            (block, pos, buf2) = (None, 0, '')
+            after = (1, 1)  # position just past the blocks of file1 consumed so far
+            while True:
+                if block is None or pos == len(block[3]):
+                    if block: after = (block[0] + block[2].count('\n'), 1) if block[2].endswith('\n') else (block[0], block[1] + len(block[3]))
+                    (block, pos) = (next(stream1, None), 0)
+                if buf2 == '': buf2 = next(stream2, (None, None, None, None))[3]
+                if block is None or buf2 is None:
+                    if block is None and buf2 is None: return None
+                    return after if block is None else locate_in_block(block, pos)
+                n = min(len(block[3]) - pos, len(buf2))
+                if block[3][pos:pos+n] != buf2[:n]:
+                    return locate_in_block(block, pos + next(i for i in xrange(n) if block[3][pos+i] != buf2[i]))
+                (pos, buf2) = (pos + n, buf2[n:])
 
 Option = collections.namedtuple("Option", "score, text, explanation, concern, prompt")
 Option.__new__.__defaults__ = (None, False)  # sets values for last 2 fields, they will be optional to init
@@ -165,9 +385,19 @@ def score_output_match(output, correct_output, pts, context, ratio=1.0, detail=N
     return results.MismatchOutput(score=0, output=output, correct_output=correct_output,
                                   detail=results.summarize_mismatch(output, correct_output, detail))
 
+def score_output_stream(output_path, correct_path, output_head, correct_head, pts, context):
+    """Like score_output_match, for outputs spooled to files (heads are just the start of each output, for reporting)"""
+    where = first_divergence(output_path, correct_path)
+    if where is None:
+        return results.Correct(score=pts, short="Submission output matches sample")
+    detail = "Submission output first differs from sample at line %d, column %d\n" % where
+    if not match_ok(output_head, correct_head): detail += results.summarize_mismatch(output_head, correct_head)
+    return results.MismatchOutput(score=0, output=output_head, correct_output=correct_head, detail=detail)
+
 # This is currently matched to the output from Valgrind version 3.5.0 and 3.7.0
 # Be warned this when versions are updated you may have to tweak
-def scrape_valgrind_report(valgrind_log, exitcode):
+def scrape_valgrind_report(valgrind_log, exitcode, heap_only=False):
+    """heap_only skips scraping errors and leaks, for when only heap totals are wanted (MemoryUse)"""
     summary = util.Struct(internal_error=None, errors=None, leaks=None)
 
     # previously compared exitcode == 1 to detect if valgrind itself crashed (but also == 1 if program exited 1), instead look for internal error txt in log
@@ -178,14 +408,14 @@ def scrape_valgrind_report(valgrind_log, exitcode):
     if "Fatal error at startup" in valgrind_log:
         return util.Struct(internal_error="fatal error on Valgrind startup (no 32bit cross compile?)")
 
-    error_free = (exitcode != testing.VALGRIND_ERROR_CODE and " 0 errors from 0 contexts" in valgrind_log)
+    error_free = heap_only or (exitcode != testing.VALGRIND_ERROR_CODE and " 0 errors from 0 contexts" in valgrind_log)
     if not error_free:
         vg_errors = "\n".join(util.grep_text("Conditional|Invalid|uninitialised|Address|destination overlap", valgrind_log))
         summary.errors = util.match_regex("(==\d+==\s+ERROR SUMMARY.*)", valgrind_log) + "\n" + vg_errors
         if not summary.errors:
             return util.Struct(internal_error="malformed Valgrind log (could not scrape ERROR SUMMARY)")
 
-    leak_free = ("All heap blocks were freed -- no leaks are possible" in valgrind_log)
+    leak_free = heap_only or ("All heap blocks were freed -- no leaks are possible" in valgrind_log)
     if not leak_free:
         leaks = util.match_regex("(?s)(==\d+==\s+LEAK SUMMARY.*)==\d+==\s+\n", valgrind_log)  # (?s) flag is DOTALL to pick up newlines to end of report
         if not leaks:
@@ -207,8 +437,59 @@ def scrape_valgrind_report(valgrind_log, exitcode):
 
     return summary
 
-def score_valgrind(output, soln_output, reject_regex, valgrind_log, exitcode, leakpts, errorpts, context):
-    valgrind = scrape_valgrind_report(valgrind_log, exitcode)
+# Leak error kinds in memcheck XML report, in order the text LEAK SUMMARY lists them
+LEAK_KINDS = collections.OrderedDict([("Leak_DefinitelyLost", "definitely lost"), ("Leak_IndirectlyLost", "indirectly lost"),
+                                      ("Leak_PossiblyLost", "possibly lost"), ("Leak_StillReachable", "still reachable")])
+
+def parse_valgrind_xml(xml_log):
+    """Reads memcheck report written with --xml=yes (protocol 4) in one incremental pass, unlike the scrape above
+    this doesn't depend on wording of Valgrind messages. Returns struct with same fields as scrape_valgrind_report
+    (errors/leaks are text summaries for the detail), plus error_kinds = {kind: count} of errors, leak_kinds =
+    {category: (bytes, blocks)} of leaks and client_msgs = list of messages client requests wrote into the report
+    (e.g. Valgrind's report of overflow in strcpy_chk). Memcheck doesn't report heap totals in XML mode, so no nallocs/nbytes"""
+    summary = util.Struct(internal_error=None, errors=None, leaks=None, error_kinds={}, leak_kinds={}, client_msgs=[])
+    kinds = {}   # unique -> kind of memory error
+    whats = collections.OrderedDict()  # distinct descriptions of memory errors, in order first reported
+    counts = {}  # unique -> number of times error occurred (from errorcounts, default 1)
+    finished = False
+    try:
+        for (event, elem) in ElementTree.iterparse(cStringIO.StringIO(xml_log)):
+            if elem.tag == "error":
+                kind = elem.findtext("kind", "")
+                if kind in LEAK_KINDS:
+                    (nbytes, nblocks) = summary.leak_kinds.get(LEAK_KINDS[kind], (0, 0))
+                    summary.leak_kinds[LEAK_KINDS[kind]] = (nbytes + int(elem.findtext("xwhat/leakedbytes", "0")),
+                                                            nblocks + int(elem.findtext("xwhat/leakedblocks", "0")))
+                else:
+                    kinds[elem.findtext("unique")] = kind
+                    whats[elem.findtext("what") or elem.findtext("xwhat/text", kind)] = True
+            elif elem.tag == "errorcounts":
+                for pair in elem.findall("pair"):
+                    counts[pair.findtext("unique")] = int(pair.findtext("count", "1"))
+            elif elem.tag == "clientmsg":
+                summary.client_msgs.append(elem.findtext("text", "").strip())
+            elif elem.tag == "status":
+                finished = (elem.findtext("state") == "FINISHED")
+            else:
+                continue  # element inside one of above, keep until its parent ends
+            elem.clear()  # done with element, drop its contents so memory use stays flat
+    except SyntaxError:  # cElementTree.ParseError
+        return util.Struct(internal_error="malformed Valgrind XML report (Valgrind crashed or submission forked?)")
+    if not finished:
+        return util.Struct(internal_error="incomplete Valgrind XML report (Valgrind terminated early?)")
+
+    if kinds:
+        for (unique, kind) in kinds.items():
+            summary.error_kinds[kind] = summary.error_kinds.get(kind, 0) + counts.get(unique, 1)
+        summary.errors = "ERROR SUMMARY: %d errors from %d contexts\n%s" % (sum(summary.error_kinds.values()), len(kinds), "\n".join(whats))
+    if any(nbytes for (nbytes, nblocks) in summary.leak_kinds.values()):
+        categories = [c for c in LEAK_KINDS.values() if c in summary.leak_kinds]
+        summary.leaks = "LEAK SUMMARY:\n" + "\n".join("%15s: %s bytes in %s blocks" % (c, ui.with_commas(summary.leak_kinds[c][0]),
+                                                         ui.with_commas(summary.leak_kinds[c][1])) for c in categories)
+    return summary
+
+def score_valgrind(output, soln_output, reject_regex, valgrind_log, exitcode, leakpts, errorpts, context, xml_report=False):
+    valgrind = parse_valgrind_xml(valgrind_log) if xml_report else scrape_valgrind_report(valgrind_log, exitcode)
     execution_errors = summarize_execution(output, soln_output, exitcode)
 
     if valgrind.internal_error:
@@ -226,7 +507,10 @@ def score_valgrind(output, soln_output, reject_regex, valgrind_log, exitcode, le
         if "incorrect output" in execution_errors and ui.get_yes_or_no("Do you want to view the discrepancy in output?"):
             print results.summarize_mismatch(output, soln_output)
         if ui.get_yes_or_no("Do you want to view the Valgrind report?"):
-            print ui.blue(valgrind_log)
+            if xml_report:  # raw XML not meant for reading, show what was parsed from it
+                print ui.blue("\n".join(s for s in [valgrind.errors, valgrind.leaks] + valgrind.client_msgs if s) or "no errors nor leaks")
+            else:
+                print ui.blue(valgrind_log)
         options = [Option(1, "code seems complete and program executed in full", "Valgrind report should be reliable"),
                    Option(0, "incomplete code and/or incomplete execution", "Valgrind report is inconclusive")]
         (score, reason) = get_score_from_options("", "Should we trust the Valgrind report for this run?", options)
@@ -244,13 +528,13 @@ def score_valgrind(output, soln_output, reject_regex, valgrind_log, exitcode, le
         return results.Correct(score=leakpts+errorpts, short="Valgrind report was clean")
 
 def score_memory_use(output, soln_output, reject_regex, soln_log, exitcode, valgrind_log, pts, multiplier, context):
-    soln = scrape_valgrind_report(soln_log, 0)
+    soln = scrape_valgrind_report(soln_log, 0, heap_only=True)
     if soln.internal_error:
         print soln_log
         raise Exception("Unable to scrape solution's memory use for efficiency comparison. Tell Julie! (%s)" % soln.internal_error)
 
     execution_errors = summarize_execution(output, soln_output, exitcode)
-    valgrind = scrape_valgrind_report(valgrind_log, exitcode)
+    valgrind = scrape_valgrind_report(valgrind_log, exitcode, heap_only=True)
     if valgrind.internal_error:
         return results.Incorrect(short="Unable to evaluate memory use %s" % valgrind.internal_error)
 
@@ -298,33 +582,134 @@ def score_memory_use(output, soln_output, reject_regex, soln_log, exitcode, valg
         if execution_errors is not None: summary += execution_errors
         return results.TooMuch(short=summary)
 
-def scrape_time_report(timelog):
-    summary = util.Struct(internal_error=None)
-    try:
-        nsecs = util.match_regex("(?s)real.*user\s+(\d+\.\d+).*sys", timelog, 1)  # use ?s for DOTALL
-        summary.nsecs = float(nsecs)  # extract user time number
-    except Exception:
-        summary.internal_error = "malformed time result"
-    return summary
+def expand_compressed(spec, names):
+    """Name compression in callgrind.out: "(id) name" defines id as name, later "(id)" alone refers back to it"""
+    if not spec.startswith("("): return spec
+    (id, _, name) = spec.partition(" ")
+    if name: names[id] = name
+    return names.get(id, spec)
+
+def parse_callgrind_out(text, ntop=5):
+    """Reads callgrind.out file (format written by --callgrind-out-file) in one pass, returns struct with
+    internal_error (None if ok), total = instructions executed (Ir) and top = list of (Ir, function) for the
+    ntop functions with highest self cost. Cost lines just after calls= are inclusive cost of the call,
+    so skipped, those instructions are already counted in the callee's own lines"""
+    npositions = 1
+    column = 0  # which cost column is Ir
+    total = None
+    names = {}  # compressed id "(n)" -> name
+    self_cost = collections.defaultdict(int)
+    fn = None
+    after_calls = False
+    for line in cStringIO.StringIO(text):
+        if line[0] in "0123456789+-*":  # cost line: positions then costs
+            if after_calls or fn is None:
+                after_calls = False
+                continue
+            fields = line.split()
+            if len(fields) > npositions + column: self_cost[fn] += int(fields[npositions + column])
+        elif line.startswith("fn="):
+            fn = expand_compressed(line[3:].strip(), names)
+        elif line.startswith("cfn="):
+            expand_compressed(line[4:].strip(), names)  # first mention of a function may be as callee
+        elif line.startswith("calls="):
+            after_calls = True
+        elif line.startswith("positions:"):
+            npositions = len(line.split()) - 1
+        elif line.startswith("events:"):
+            events = line.split()[1:]
+            if "Ir" not in events: return util.Struct(internal_error="callgrind output has no instruction counts (events: %s)" % " ".join(events))
+            column = events.index("Ir")
+        elif line.startswith("totals:") or line.startswith("summary:"):
+            total = int(line.split()[1 + column])
+    if not self_cost:
+        return util.Struct(internal_error="malformed callgrind output (no costs found, callgrind crashed?)")
+    if total is None: total = sum(self_cost.values())
+    top = sorted(((ir, name) for (name, ir) in self_cost.items()), reverse=True)[:ntop]
+    return util.Struct(internal_error=None, total=total, top=top)
+
+def score_instruction_count(output, soln_output, reject_regex, soln_log, exitcode, callgrind_log, pts, multiplier, ntop, context):
+    soln = parse_callgrind_out(soln_log, ntop)
+    if soln.internal_error:
+        raise Exception("Unable to read solution's instruction count for efficiency comparison. Tell Julie! (%s)" % soln.internal_error)
 
-def score_time_use(output, soln_output, timelog, reject_regex, exitcode, soln_time, pts, multiplier, context):
-    timeused = scrape_time_report(timelog)
-    if timeused.internal_error:
-        raise Exception("Unable to scrape runtime for efficiency comparison. Tell Julie! (%s)" % timeused.internal_error)
+    execution_errors = summarize_execution(output, soln_output, exitcode)
+    callgrind = parse_callgrind_out(callgrind_log, ntop)
+    if callgrind.internal_error:
+        return results.Incorrect(short="Unable to evaluate instruction count %s" % callgrind.internal_error)
+
+    if reject_regex is not None and re.match(reject_regex, output):
+        return results.Inconclusive()
+
+    ratio = float(callgrind.total)/max(1, soln.total)
+    summary = "Instruction count %s is %.1fx soln" % (ui.with_commas(callgrind.total), ratio)
+    top = "Most expensive functions (instructions executed within function itself):\n" + \
+          "\n".join("%15s  %s" % (ui.with_commas(ir), name) for (ir, name) in callgrind.top) + '\n'
+    if execution_errors and ratio <= multiplier:  # count ok, but run was fishy, verify "good faith"
+        if context in [testing.FOR_DRYRUN, testing.FOR_TESTSUITE]:  # just return score 0 with summary of findings if non-interactive
+            return results.Inconclusive(short="%s %s" % (summary, execution_errors))
+        if context == testing.FOR_PREGRADE:
+            return results.Deferred()  # requires judgment, defer to interactive grader
+        print "Submission executes: %s instructions\nSolution executes:   %s instructions" % (ui.blue(ui.with_commas(callgrind.total)), ui.with_commas(soln.total))
+        print ui.red("Instruction count ok (within %sx of solution), but run had execution errors that cast doubt on its reliability." % multiplier)
+        print ui.bold("Errors: ") + ui.blue(execution_errors)
+        if "incorrect output" in execution_errors and ui.get_yes_or_no("Do you want to view the discrepancy in output?"):
+            print results.summarize_mismatch(output, soln_output)
+        options = [Option(1, "code seems complete and program executed in full", "instruction count should be reliable"),
+                   Option(0, "incomplete code and/or incomplete execution", "instruction count is inconclusive")]
+        (score, reason) = get_score_from_options("", "Should we trust the instruction count for this run?", options)
+        if score == 0:  # report is unreliable, result is inconclusive
+            return results.Inconclusive()
+
+    # from here, use instruction count as truth
+    if ratio > multiplier:
+        return results.TooMuch(short=summary + (" " + execution_errors if execution_errors else ""), detail=top)
+    if context == testing.FOR_DRYRUN and ratio > 1.5:  # just so I can see what is happening
+        return results.TooMuch(score=pts, short=summary, detail=top)
+    return results.Correct(score=pts, short="Passed, instruction count on par with expectation")
+
+def median(values):
+    ordered = sorted(values)
+    mid = len(ordered)//2
+    return ordered[mid] if len(ordered) % 2 else (ordered[mid-1] + ordered[mid])/2.0
+
+def time_ratios(trial_times, aggregate):
+    """For list of (student secs, soln secs) from paired trials, returns tuple (student secs, soln secs, ratio, low, high)
+    aggregated as median (of per-trial ratios) or min (fastest of each). low..high is middle half of per-trial ratios
+    (all of them when under 4 trials), the band where ratio could plausibly be on a rerun"""
+    ratios = sorted(s/max(p, 0.01) for (s, p) in trial_times)  # times are in secs, floor soln at 0.01 secs so as not to divide by 0
+    trim = len(ratios)//4
+    (low, high) = (ratios[trim], ratios[-1-trim])
+    if aggregate == "min":
+        (nsecs, soln_secs) = (min(s for (s, p) in trial_times), min(p for (s, p) in trial_times))
+        return (round(nsecs, 2), round(soln_secs, 2), nsecs/max(soln_secs, 0.01), low, high)
+    (nsecs, soln_secs) = (median(s for (s, p) in trial_times), median(p for (s, p) in trial_times))
+    return (round(nsecs, 2), round(soln_secs, 2), median(ratios), low, high)
+
+def score_time_use(output, soln_output, usage, reject_regex, exitcode, soln_time, pts, multiplier, context, trial_times=None, aggregate="median"):
+    if usage is None:
+        raise Exception("No resource usage recorded for efficiency comparison. Tell Julie!")
+    nsecs = round(usage.utime, 2)  # user cpu time, same measure (and precision) /usr/bin/time used to report
 
     if reject_regex is not None and re.match(reject_regex, output):
         return results.Inconclusive()
 
     execution_errors = summarize_execution(output, soln_output, exitcode)
-    ratio = float(timeused.nsecs)/soln_time
+    ratio = nsecs/soln_time
+    if trial_times:  # compare against solution timed alongside instead of fixed soln_time
+        (nsecs, soln_time, ratio, low, high) = time_ratios(trial_times, aggregate)
+        if low <= multiplier < high:  # trials disagree whether over, too close to call
+            if context == testing.FOR_PREGRADE:
+                return results.Deferred()
+            return results.Inconclusive(short="Time use borderline, %s secs is %.1fx soln (%.1fx to %.1fx over %d trials)" % (nsecs, ratio, low, high, len(trial_times)))
 
     if execution_errors and ratio <= multiplier:  # time ok, but run was fishy, verify "good faith"
         if context in [testing.FOR_DRYRUN, testing.FOR_TESTSUITE]:  # if not for grading, score as 0, give summary of findings
-            return results.Inconclusive(short="Time use (%s secs is %.1fx soln) %s" % (timeused.nsecs, ratio, execution_errors))
+            return results.Inconclusive(short="Time use (%s secs is %.1fx soln) %s" % (nsecs, ratio, execution_errors))
         if context == testing.FOR_PREGRADE:
             return results.Deferred()  # requires judgment, defer to interactive grader
 
-        print "Submission uses: %s secs\nSolution uses:   %s secs" % (ui.blue(timeused.nsecs), soln_time)
+        print "Submission uses: %s secs\nSolution uses:   %s secs" % (ui.blue(nsecs), soln_time)
         print ui.red("Time use ok (within %sx of solution), but run had execution errors that cast doubt on reliability of timing data." % multiplier)
         print ui.bold("Errors: ") + ui.blue(execution_errors)
         if "incorrect output" in execution_errors and ui.get_yes_or_no("Do you want to view the discrepancy in output?"):
@@ -335,11 +720,11 @@ def score_time_use(output, soln_output, timelog, reject_regex, exitcode, soln_ti
         if score == 0:  # report is unreliable, result is inconclusive
             return results.Inconclusive()
 
-    # from here, use scrape of time usage as truth
+    # from here, use reported cpu time as truth
     if ratio <= multiplier:
         return results.Correct(score=pts, short="Passed, time on par with expectation")
     else:
-        summary = "Time use %s secs is %.1fx soln " % (timeused.nsecs, ratio)
+        summary = "Time use %s secs is %.1fx soln " % (nsecs, ratio)
         if execution_errors is not None: summary += execution_errors
         return results.TooMuch(short=summary)
 
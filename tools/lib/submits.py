@@ -6,9 +6,12 @@ Submission class that encapsulates info about a grade report.
 A grade report consists of a dict of test names and results, along with
 the submit information (revision, submission date, days late)
 A grade report is stored as a pickle file named GCACHE
+Saving a single test result doesn't rewrite GCACHE, the result is appended to GCACHE.journal instead.
+The journal is replayed on load, and compacted (GCACHE rewritten, journal removed) every so often
+and whenever anything other than a test result changes.
 """
 
-import collections, cPickle, datetime, os
+import collections, cPickle, datetime, os, random
 import course, gen, results, util
 
 
@@ -16,7 +19,11 @@ class Submission(object):
     """This object represents the grade report for a student's submission."""
 
     P_FILENAME = "GCACHE"
+    J_SUFFIX = ".journal"
     VERSION = 2  # attempt as simple versioning system to not blunder through GCACHE changes
+    JOURNAL_LIMIT = 50  # compact after this many journaled results
+    journal_id = None  # journal only applies to GCACHE with same id (each compaction assigns new id)
+    njournaled = 0
 
     def __init__(self, reponame, repo_path, head_rev, subdate):
         self.version = self.VERSION
@@ -35,6 +42,7 @@ class Submission(object):
         """overridden to remove transient/volatile variables from what is pickled"""
         state = dict(self.__dict__)  # copy our dict
         if "writeback_path" in state: del state["writeback_path"]  # don't save the path in pickle, always re-set from where read
+        if "njournaled" in state: del state["njournaled"]
         return state
 
     def mark_finished(self):
@@ -60,10 +68,46 @@ class Submission(object):
         # GCACHE is a symlink for a partnered assign7
         # it is error to be writing through to it and should never happen
         assert(not os.path.islink(self.writeback_path)), "Cannot write through linked GCACHE %s" % self.writeback_path
+        self.journal_id = "%016x" % random.getrandbits(64)  # any leftover journal (e.g. remove below fails) no longer applies
         tmpfile = self.writeback_path + "~"
         with open(tmpfile, "w") as fp:
             cPickle.dump(self, fp)
         os.rename(tmpfile, self.writeback_path)  # atomic save, just in case
+        util.remove_files(self.writeback_path + self.J_SUFFIX)  # everything journaled is now in GCACHE
+        self.njournaled = 0
+
+    def journal_result(self, testname, result):
+        """Append record of result to journal (None for removed), first record of new journal is header (VERSION, journal_id).
+        Records are separate pickles, replay stops at first unreadable, so partial last record from a crash is just dropped"""
+        if not self.writeback_path: return
+        assert(not os.path.islink(self.writeback_path)), "Cannot write through linked GCACHE %s" % self.writeback_path
+        journal_path = self.writeback_path + self.J_SUFFIX
+        with open(journal_path, "ab") as fp:
+            if fp.tell() == 0: cPickle.dump((self.VERSION, self.journal_id), fp)
+            cPickle.dump((testname, result), fp)
+        self.njournaled += 1
+        if self.njournaled >= self.JOURNAL_LIMIT: self.commit_changes()
+
+    def replay_journal(self, picklepath):
+        """Apply results recorded in journal alongside GCACHE at picklepath (if it matches this GCACHE).
+        Returns True if journal ends in partial record, which must be compacted away before appending more"""
+        try:
+            with open(os.path.realpath(picklepath) + self.J_SUFFIX, "rb") as fp:  # partner's GCACHE may be a symlink, journal is next to real one
+                if cPickle.load(fp) != (self.VERSION, self.journal_id): return False  # stale journal or different format, ignore
+                good = fp.tell()
+                while good < os.fstat(fp.fileno()).st_size:
+                    (testname, result) = cPickle.load(fp)
+                    if result:
+                        self.testresults[testname] = result
+                    elif testname in self.testresults:
+                        del self.testresults[testname]
+                    self.njournaled += 1
+                    good = fp.tell()
+        except (IOError, OSError):
+            return False  # no journal
+        except (EOFError, cPickle.UnpicklingError, ValueError, TypeError, AttributeError, ImportError, IndexError):
+            return True   # partial record at end
+        return False
 
     def cached_result_for(self, test):
         return self.testresults[test.name] if test.name in self.testresults else None
@@ -73,7 +117,7 @@ class Submission(object):
             self.testresults[testname] = result
         elif testname in self.testresults:  # setting result to None removes test from results
             del self.testresults[testname]
-        self.commit_changes()  # dump intermediate results after test run
+        self.journal_result(testname, result)  # record intermediate results after test run
 
     MANUAL_ADJUSTMENT = "Adjustment"
 
@@ -184,6 +228,8 @@ class Submission(object):
                 cls.LAST_READ_TIME = elapsed
 
             assert(hasattr(sub, "version") and sub.version == cls.VERSION), "%s incompatible with this version of tools" % gen.shortpath(picklepath)
+            sub.writeback_path = picklepath if writeback and not os.path.islink(picklepath) else None
+            if sub.replay_journal(picklepath): sub.commit_changes()  # drop partial record (no-op if no writeback)
             # unarchived web review needs path being read from, path not stored in GCACHE/WEB_REVIEW
             for r in sub.testresults.values():  # manually update webreview result (yuck)
                 if isinstance(r, results.ParseWebReview):
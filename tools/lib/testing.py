@@ -12,8 +12,8 @@ The testing module has the logic for different kinds of tests and their executio
      how they are executed and/or scored (see scoring module)
 """
 
-import copy, commands, inspect, math, os, pty, re, resource, signal, subprocess, sys, tempfile, time, traceback
-import gen, results, scoring, ui, util
+import contextlib, copy, commands, errno, inspect, itertools, math, os, pty, re, resource, select, signal, sre_constants, sre_parse, sys, tempfile, threading, traceback
+import digests, gen, results, scoring, ui, util, workspace
 from common import *
 from webreview import WebReview
 
@@ -23,6 +23,12 @@ FOR_SANITY, FOR_DRYRUN, FOR_RUNTESTS, FOR_PREGRADE, FOR_AUTOGRADER, FOR_TESTSUIT
 NO_EXEC_CODES = [125, 126, 127]  # 125 timeout cannot run, 126 bash no x permission, 127 bash command not found
 TIMED_OUT_CODE = 124    # 124 status from timeout when period expires on monitored program
 VALGRIND_ERROR_CODE = 88
+MAXFD = os.sysconf("SC_OPEN_MAX")
+
+# contexts in which test progress/results are printed as each test runs
+NOISY_CONTEXTS = [FOR_AUTOGRADER, FOR_RUNTESTS, FOR_SANITY]
+# contexts in which control-C quits, in others (grading) the interrupted test is just deferred
+QUIT_CONTEXTS = [FOR_SANITY, FOR_RUNTESTS, FOR_TESTSUITE, FOR_DRYRUN]
 
 # used for errors during execute_command
 class TestExecuteError(Exception):
@@ -42,118 +48,445 @@ class SolutionError(Exception):
 # and code somewhat less goopy (no more CRLF, bash scrape, etc).
 # However, it has subtle dependencies (e.g. use of redirect to avoid bash exec-overlay)
 # that may come back to haunt us later
-def execute_command(wd, command, timeout=None, env_overrides={}, logged=False, solnlen=-1):
-    """Run the specific command in directory wd.  Timeout specifies seconds to
+def execute_command(wd, command, timeout=None, env_overrides={}, logged=False, solnlen=-1, kill_on_overflow=False, spool=False):
+    """Run the specific command in directory wd.  Timeout specifies seconds (int or float) to
     wait for command to finish (use <= 0 for infinite/no timeout).
-    Returns a struct with fields output, exitcode, time
+    If kill_on_overflow, command is killed as soon as its output goes past the cap
+    (rather than running on to finish or time out while its excess output is discarded)
+    If spool, output is written to a temp file as read, only its head is held in memory
+    Returns a struct with fields output, exitcode, time (elapsed seconds as float), runaway (True if killed for output over cap),
+    usage (resource use of command and all its waited-for descendants, see rusage_struct, except that with core_cmd,
+    utime/stime are cpu of core_cmd alone, as /usr/bin/time wrapped around it used to report),
+    output_path (if spool, the temp file with entire output, caller must remove, else None)
     Exitcode will be negative for signals, 0 for success, positive for other exit codes."""
+    ex = Execution(wd, command, timeout, env_overrides, logged, solnlen, kill_on_overflow, spool)
+    try:
+        drive([ex])
+    finally:
+        if not ex.result and ex.spool: ex.discard_spool()  # (interrupted, or failed) no result to hand spooled output to
+    return ex.outcome()
+
+def drive(executions):
+    """Runs all executions to completion from this one thread. Polls the descriptors of every execution
+    (child output, bash errors, core_cmd status) and reads whichever are ready, so no one stream can
+    stall on a full pipe while another is being read. Each execution is finished as soon as its
+    streams are drained. (Python 2 has no asyncio, this poll loop stands in as the event loop)"""
+    poller = select.poll()
+    captures = {}  # fd -> (execution, capture)
+    for ex in executions:
+        if not ex.started: ex.start()
+        for c in ex.captures:
+            captures[c.fd] = (ex, c)
+            poller.register(c.fd, select.POLLIN)  # hangup/error always reported, read then sees EOF
+    while captures:
+        try:
+            ready = poller.poll()
+        except select.error as e:
+            if e.args[0] == errno.EINTR: continue  # interrupted by signal, just retry
+            raise
+        for (fd, event) in ready:
+            (ex, c) = captures[fd]
+            if not c.read_some():  # capture closed fd at EOF
+                poller.unregister(fd)
+                del captures[fd]
+                if ex.is_drained(): ex.finish()
+
+class Execution(object):
+    """One run of a command, see execute_command for args. Split into start (fork child), read as output
+    becomes available (util.Capture per stream), and finish (reap child, decode status) so that
+    many executions can be multiplexed by drive(). After drive, outcome() has result (or raises error)"""
+
+    def __init__(self, wd, command, timeout=None, env_overrides={}, logged=False, solnlen=-1, kill_on_overflow=False, spool=False):
+        self.wd = wd
+        self.command = command
+        self.timeout = timeout
+        self.env_overrides = env_overrides
+        self.logged = logged
+        self.kill_on_overflow = kill_on_overflow
+        self.spool = tempfile.NamedTemporaryFile(prefix="output-", delete=False) if spool else None
+        # to curb runaway output, cap at 2x solnlen or 100K whichever larger
+        # solnlen will be None if executing solution, use 100MB as "unbounded"
+        HUGE = 1000000000
+        self.max_output_len = min(max(100000, solnlen*2), HUGE) if solnlen is not None else HUGE
+        self.started = False
+        self.runaway = False
+        self.result = None
+        self.error = None
+
+    def start(self):
+        command = self.command
+        if self.logged:
+            self.tmpfile = tempfile.NamedTemporaryFile(delete=True)  # will remove itself from filesystem on close
+            command = expand_vars(command, {"logpath": self.tmpfile.name})
+        error_pipe = os.pipe()
+        status_pipe = os.pipe()
+
+        # Need detailed comment to explain mchang bash wizardry below
+        self.has_core_cmd = "core_cmd" in command
+        if self.has_core_cmd:  # 2>/dev/null discards bash reporting when core_cmd terminates uncleanly
+            to_str = "/usr/bin/timeout -k9 %g" % self.timeout if self.timeout else ""  # timeout accepts fractional seconds
+            # bash times (cpu of shell, then of its waited-for children) before and after gives cpu of core_cmd alone
+            bash_cmd = 'core_cmd() { times >&%d ; { %s "$@"  2>&1 ; } 2>/dev/null ; local rc=$? ; times >&%d ; echo $rc >&%d ; return 0; }; { %s ; }' % \
+                       (status_pipe[1], to_str, status_pipe[1], status_pipe[1], command)
+        else:
+            bash_cmd = '{ %s ; } 2>&1  ' % (command)
+        #if gen.NT_RUNNING: print ui.faint("executing: %s" % (bash_cmd))
+
+        child_pid, child_fd = pty.fork()
+        if child_pid == 0:  # CHILD HERE
+            try:  # blanket try/except to catch any errors when creating/launching child
+                os.chdir(self.wd)
+                soft_limit = int(math.ceil(self.timeout)) if self.timeout else 45  # rlimit is whole seconds only
+                resource.setrlimit(resource.RLIMIT_CPU, (soft_limit, soft_limit + 15))  # soft limit at timeout, hard timeout 15 seconds more
+                try:
+                    os.setsid() # create a new session, so that we can identify child processes that persist after this process exits
+                except OSError:
+                    pass    # fails if this process is already a process group leader
+                signal.signal(signal.SIGPIPE, signal.SIG_DFL)  # get default behavior for sigpipe, http://bugs.python.org/issue1652
+                os.dup2(os.open("/dev/null", os.O_RDONLY), 0)  # if attempt read stdin with no redirect, give immediate EOF (otherwise hangs in read)
+                os.dup2(error_pipe[1], 2)  # re-route stderr to error_pipe
+                # close all other descriptors (unused pipe ends, plus any inherited from tests running concurrently
+                # in other threads, which would otherwise hold those pipes open), keep only status_pipe write end
+                close_fds(keep=status_pipe[1])
+                # -o pipefail to propagate bad exit code from program through pipeline
+                # -u to raise error on undefined shell var (default would silently expand to empty)
+                # TODO: MC: Remove -u to avoid issues on rice with init script
+                args = ["/bin/bash", "-co", "pipefail", bash_cmd]
+                combined = dict(os.environ)     # copy existing environment for child
+                combined.update(self.env_overrides)  # merge in any overrides
+                combined["SHELL"] = "/bin/bash" # this var necessary in some CS110 situation?
+                combined["LC_ALL"] = "C"        # avoid curly quotes from gcc, timeout, and others
+                os.execve(args[0], args, combined)
+            except Exception:
+                # child failed to create/launch, need to tell parent what happened, but... wacky communication channel
+                # have to use child process's exitcode and output stream
+                traceback.print_exc()   # dump backtrace into child output, can be read by parent
+                sys.exit(127)           # child process exits with NO EXEC CODE to indicate failed to launch
+
+        # PARENT HERE
+        os.close(error_pipe[1])
+        os.close(status_pipe[1])
+        if not self.has_core_cmd: os.close(status_pipe[0])
+        util.stty_onclr(child_fd)  # disable pty's translate of LF to CRLF
+        self.child_pid = child_pid
+        track_session(child_pid)
+        self.started = True
+        self.starttime = util.monotonic()
+        # child_fd contains child stdout + stderr (and tty) of core_cmd
+        # error_pipe is where bash/pipeline will report errors, status_pipe has just exit code of core_cmd
+        self.output = util.Capture(child_fd, self.max_output_len, self.on_overflow, self.spool)
+        self.err_out = util.Capture(error_pipe[0], self.max_output_len)
+        self.status = util.Capture(status_pipe[0], 200) if self.has_core_cmd else None
+        self.captures = [c for c in [self.output, self.err_out, self.status] if c]
+
+    def on_overflow(self):
+        if self.kill_on_overflow:
+            self.runaway = True
+            kill_session(self.child_pid, spare_leader=True)  # kill command, but not bash, so it still reports status
+
+    def is_drained(self):
+        return all(c.eof for c in self.captures)
+
+    def finish(self):
+        try:
+            self.result = self.reap()
+        except Exception:
+            self.error = sys.exc_info()  # hold on to re-raise from outcome(), don't disrupt other executions in drive
+            if self.spool: self.discard_spool()  # no result to hand spooled output to
+
+    def discard_spool(self):
+        self.spool.close()
+        util.remove_files(self.spool.name)
+
+    def outcome(self):
+        if self.error: raise self.error[0], self.error[1], self.error[2]
+        return self.result
+
+    def reap(self):
+        if self.spool: self.spool.close()
+        output = self.output.value()
+        # displeasing re.sub, but can't prevent timeout from generating this message when core cmd terminates uncleanly
+        if "monitored command dumped core" in output: output = re.sub("(?m)^.*monitored command dumped core.*$", "", output)
+        err_out = self.err_out.value()
+        log = util.read_file(self.tmpfile.name) if self.logged else None
+        # now wait for child to complete (timeout will kill child if needed), wait4 also gathers
+        # resource use for whole tree (bash waits on core_cmd/timeout, timeout waits on program)
+        (pid, bash_status, rusage) = os.wait4(self.child_pid, 0)
+
+        kill_session(self.child_pid)  # find any lingering grandchild processes, and kill them
+        untrack_session(self.child_pid)
+        elapsed_time = util.monotonic() - self.starttime
+
+        bash_exitcode = os.WEXITSTATUS(bash_status) if os.WIFEXITED(bash_status) else -os.WTERMSIG(bash_status)
+        # zero exitcode means bash+entire pipeline happy
+        # if non-zero, harder to say for sure what happened
+        # -o pipefail propagates out non-zero status of any command in pipeline
+        # exitcode 1 is used by bash when command didn't parse, but also could be
+        # sign of harmless non-success if pipeline had a command that exited 1
+        # (such as a grep that didn't match anything...)
+        # if any text on stderr, assume that indicates problem otherwise try
+        # discern from exit code:
+        # accept as ok anything < 126, also ignore 141
+        # exitcode 141 means pipe closed, e.g. yes | head -- no big, just ignore
+
+        if len(err_out) or (bash_exitcode >= 126 and bash_exitcode != 141):
+            raise TestExecuteError("execute_command '%s' bash error (%d) %s" % (self.command, bash_exitcode, err_out if err_out else self.command))
+
+        usage = rusage_struct(rusage)
+        if not self.has_core_cmd:
+            shellcode = bash_exitcode
+        else:
+            (shellcode, core_times) = parse_core_status(self.status.value())
+            if shellcode is None:
+                print("WARNING: execute_command unable to read exitcode from status_pipe")
+                shellcode = -100
+            if core_times: (usage.utime, usage.stime) = core_times  # cpu of core_cmd only, not bash and rest of pipeline
+
+        # when process exited with signal, shell adds 128 to exitcode, so here
+        # remap shellcode back to -signum, i.e. shellcode 139 becomes -11 (segv)
+        if shellcode in range(128, 128 + signal.NSIG):
+            exitcode = 128 - shellcode
+        else:
+            exitcode = shellcode
+        if exitcode == -signal.SIGXCPU: exitcode = TIMED_OUT_CODE  # map XCPU to Timeout code to unify handling later
+        return util.Struct(output=output, exitcode=exitcode, time=elapsed_time, log=log, runaway=self.runaway, usage=usage,
+                           output_path=self.spool.name if self.spool else None)
+
+def run_isolated(test, spaces, context, repo):
+    wd = spaces.acquire()
+    try:
+        return test.run(wd, context, False, repo)
+    finally:
+        spaces.release(wd)
+
+TIMES_REGEX = re.compile(r"(\d+)m(\d+(?:\.\d+)?)s (\d+)m(\d+(?:\.\d+)?)s")
+
+def parse_core_status(text):
+    """Status pipe has output of bash times before and after core_cmd (each is line of shell's user/sys cpu, then
+    line of its children's), then exitcode of core_cmd. Returns tuple (exitcode, (utime, stime) of core_cmd alone),
+    exitcode None if not reported, times None if not both reported"""
+    lines = text.strip().split('\n')
+    try:
+        exitcode = int(lines[-1])
+    except ValueError:
+        return (None, None)
+    times = [TIMES_REGEX.match(line) for line in lines[:-1]]
+    if len(times) != 4 or not all(times): return (exitcode, None)
+    (before, after) = [(60*int(m.group(1)) + float(m.group(2)), 60*int(m.group(3)) + float(m.group(4))) for m in (times[1], times[3])]
+    return (exitcode, (max(0.0, after[0] - before[0]), max(0.0, after[1] - before[1])))
+
+def rusage_struct(ru):
+    """Copy the fields of interest from resource.struct_rusage into a plain Struct (struct_rusage can't be pickled)
+    cpu times in seconds, maxrss in kilobytes, page faults and context switches are counts"""
+    return util.Struct(utime=ru.ru_utime, stime=ru.ru_stime, maxrss=ru.ru_maxrss, minflt=ru.ru_minflt, majflt=ru.ru_majflt,
+                       nvcsw=ru.ru_nvcsw, nivcsw=ru.ru_nivcsw)
+
+def run_tests(tests, path, context, noisy=True, repo=None, jobs=1, starting=None):
+    """Generator that runs each test on the submission at path, yields tuple (test, result) in same
+    order as tests. A test that requires a test which did not pass is not run, its result is Skipped.
+    A required test not run here counts by its previous result for repo, if any (as in batch pregrade).
+    With jobs > 1, tests are executed concurrently by a pool of that many workers, each test starting
+    once the tests it requires have finished. A barrier test (e.g. BuildClean) waits for all tests
+    ahead of it to finish, then runs alone before any test after it starts. Tests running concurrently
+    each get own workspace cloned from the submission (see workspace module) unless the test
+    can't be isolated (e.g. GraderReview). Noisy reporting is always printed in the order of tests.
+    On control-C, commands of the tests running in the pool are killed, and those tests are deferred
+    (or run quits, depending on context) as a test interrupted in serial run would be.
+    Optional starting(test) is called as each test is started (e.g. to show progress)"""
+    if starting is None: starting = lambda t: None
+    done = {}  # name -> result for each test finished so far
+    previous = repo.sub.testresults if repo and repo.sub else {}  # name -> result saved by earlier grading
+    if jobs <= 1:
+        for t in tests:
+            unmet = unmet_requirement(t, done, previous)
+            if unmet:
+                done[t.name] = skipped(t, unmet)
+                if noisy and context in NOISY_CONTEXTS:
+                    t.announce(path)
+                    print done[t.name].string_for_context(context)
+            else:
+                starting(t)
+                done[t.name] = t.run(path, context, noisy, repo)
+            yield (t, done[t.name])
+        return
+    noisy = noisy and context in NOISY_CONTEXTS
+    names = set(t.name for t in tests)  # requires naming a test not in this run are ignored
+    pool = util.WorkerPool(jobs)
+    scope = object()  # tests run under job key (scope, n), so their commands can be killed on control-C
+    interrupted = set()  # n for tests in pool when control-C came, result is Deferred whatever they return
+    start = 0
+    spaces = None  # workspaces snapshot taken when first needed (i.e. after build), refreshed after each barrier
+    try:
+        while start < len(tests):
+            # tests from start up to next barrier are independent (apart from requires), run them in the pool
+            end = next((n for n in range(start, len(tests)) if tests[n].is_barrier), len(tests))
+            waiting = range(start, end)  # not yet started, in order
+            finished = {}  # n -> (result, exc_info), held until its turn to be reported
+            fresh = False  # base of spaces brought up to date since last barrier
+            n = start
+            while n < end:
+                for m in list(waiting):  # start (or skip) every test whose required tests have finished
+                    if any(r in names and r not in done for r in tests[m].requirements()): continue
+                    waiting.remove(m)
+                    unmet = unmet_requirement(tests[m], done, previous)
+                    if unmet:
+                        done[tests[m].name] = skipped(tests[m], unmet)
+                        finished[m] = (done[tests[m].name], None)
+                        continue
+                    starting(tests[m])
+                    if tests[m].can_isolate and end - start > 1:
+                        if not spaces: spaces = workspace.Workspaces(path)
+                        elif not fresh: spaces.refresh()  # barrier may have changed submission (e.g. build)
+                        fresh = True
+                        pool.submit(m, run_in_job, (scope, m), run_isolated, tests[m], spaces, context, repo)
+                    else:  # workers run quiet, report from here
+                        pool.submit(m, run_in_job, (scope, m), tests[m].run, path, context, False, repo)
+                if n not in finished:
+                    assert pool.has_outstanding(), "Test %s requires a test that comes after it" % tests[n].name
+                    try:
+                        (key, result, exc_info) = pool.next_finished()
+                    except KeyboardInterrupt:
+                        if context in QUIT_CONTEXTS: raise  # running tests are killed on the way out
+                        for m in list(pool.running):
+                            interrupted.add(m)
+                            cancel_job((scope, m))
+                        continue
+                    if key in interrupted:
+                        (result, exc_info) = (results.Deferred(), None)
+                        result.set_test(tests[key])
+                    finished[key] = (result, exc_info)
+                    if not exc_info: done[tests[key].name] = result
+                    continue  # that test finishing may let waiting tests start
+                (result, exc_info) = finished.pop(n)
+                if exc_info: raise exc_info[0], exc_info[1], exc_info[2]
+                if noisy:
+                    tests[n].announce(path)
+                    print result.string_for_context(context)
+                yield (tests[n], result)
+                n += 1
+            if end < len(tests):  # barrier runs in main thread (may need to interact with user)
+                t = tests[end]
+                unmet = unmet_requirement(t, done, previous)
+                if unmet:
+                    done[t.name] = skipped(t, unmet)
+                    if noisy:
+                        t.announce(path)
+                        print done[t.name].string_for_context(context)
+                else:
+                    starting(t)
+                    done[t.name] = t.run(path, context, noisy, repo)
+                yield (t, done[t.name])
+            start = end + 1
+    finally:
+        for m in list(pool.running): cancel_job((scope, m))  # (if leaving early) don't wait for tests still running
+        pool.shutdown()
+        if spaces: spaces.cleanup()
+
+def run_in_job(key, fn, *args):
+    with job_scope(key):
+        return fn(*args)
+
+def unmet_requirement(test, done, previous={}):
+    """Returns name of first test required by test that finished without passing (None if no such test).
+    done is dict name -> result of tests finished so far, previous has results (e.g. cached from earlier
+    grading) for required tests not in done"""
+    for r in test.requirements():
+        result = done.get(r, previous.get(r))
+        if result and not result.satisfies_requirement(): return r
+    return None
+
+def skipped(test, unmet):
+    r = results.Skipped(required=unmet)
+    r.set_test(test)
+    return r
+
+_job = threading.local()   # .key of job this thread is working on (see job_scope)
+_job_sessions = {}  # job key -> set of session ids (child pids) of its commands still running
+_cancelled_jobs = set()
+_job_lock = threading.Lock()
+
+@contextlib.contextmanager
+def job_scope(key):
+    """Commands executed within (by this thread) are tracked under job key, so cancel_job(key) can kill them"""
+    with _job_lock:
+        _job_sessions[key] = set()
+    _job.key = key
+    try:
+        yield
+    finally:
+        _job.key = None
+        with _job_lock:
+            del _job_sessions[key]
+            _cancelled_jobs.discard(key)
+
+def cancel_job(key):
+    """Kills the commands job key has running, and any it goes on to start, so an abandoned job (e.g. one that
+    took too long) frees its worker. Does nothing if job has already ended"""
+    with _job_lock:
+        if key not in _job_sessions: return
+        _cancelled_jobs.add(key)
+        sids = list(_job_sessions[key])
+    for sid in sids: kill_job_session(sid)
+
+def kill_job_session(sid):
+    kill_session(sid)
+    try:
+        os.kill(sid, signal.SIGKILL)  # child may not have made its session yet (then it has no children either)
+    except OSError:
+        pass
 
-    # to curb runaway output, cap at 2x solnlen or 100K whichever larger
-    # solnlen will be None if executing solution, use 100MB as "unbounded"
-    HUGE = 1000000000
-    max_output_len = min(max(100000, solnlen*2), HUGE) if solnlen is not None else HUGE
-
-    if logged:
-        tmpfile = tempfile.NamedTemporaryFile(delete=True)  # will remove itself from filesystem on close
-        command = expand_vars(command, {"logpath": tmpfile.name})
-    error_pipe = os.pipe()
-    status_pipe = os.pipe()
-
-    # Need detailed comment to explain mchang bash wizardry below
-    has_core_cmd = "core_cmd" in command
-    if has_core_cmd:  # 2>/dev/null discards bash reporting when core_cmd terminates uncleanly
-        to_str = "/usr/bin/timeout -k9 %s" % timeout if timeout else ""
-        bash_cmd = 'core_cmd() { { %s "$@"  2>&1 ; } 2>/dev/null ; echo $? >&%d ; return 0; }; { %s ; }' % (to_str, status_pipe[1], command)
-    else:
-        bash_cmd = '{ %s ; } 2>&1  ' % (command)
-    #if gen.NT_RUNNING: print ui.faint("executing: %s" % (bash_cmd))
-
-    child_pid, child_fd = pty.fork()
-    if child_pid == 0:  # CHILD HERE
-        try:  # blanket try/except to catch any errors when creating/launching child
-            os.chdir(wd)
-            soft_limit = timeout if timeout else 45
-            resource.setrlimit(resource.RLIMIT_CPU, (soft_limit, soft_limit + 15))  # soft limit at timeout, hard timeout 15 seconds more
+def track_session(sid):
+    key = getattr(_job, "key", None)
+    if key is None: return
+    with _job_lock:
+        _job_sessions[key].add(sid)
+        cancelled = key in _cancelled_jobs
+    if cancelled: kill_job_session(sid)
+
+def untrack_session(sid):
+    key = getattr(_job, "key", None)
+    if key is None: return
+    with _job_lock:
+        _job_sessions[key].discard(sid)
+
+def close_fds(keep):
+    """Closes every descriptor from 3 up except keep. Only those open (as listed in /proc/self/fd) are closed,
+    closerange to MAXFD makes a call per possible descriptor, slow where the limit is very large"""
+    try:
+        fds = [int(fd) for fd in os.listdir("/proc/self/fd")]  # (includes fd of listing itself, already closed)
+    except OSError:
+        fds = range(3, min(MAXFD, 65536))  # no /proc, fall back to (capped) range
+    for fd in fds:
+        if fd >= 3 and fd != keep:
             try:
-                os.setsid() # create a new session, so that we can identify child processes that persist after this process exits
+                os.close(fd)
             except OSError:
-                pass    # fails if this process is already a process group leader
-            signal.signal(signal.SIGPIPE, signal.SIG_DFL)  # get default behavior for sigpipe, http://bugs.python.org/issue1652
-            os.dup2(os.open("/dev/null", os.O_RDONLY), 0)  # if attempt read stdin with no redirect, give immediate EOF (otherwise hangs in read)
-            os.dup2(error_pipe[1], 2)  # re-route stderr to error_pipe
-            os.close(error_pipe[0])    # close all unused pipe ends
-            os.close(error_pipe[1])
-            os.close(status_pipe[0])
-            # -o pipefail to propagate bad exit code from program through pipeline
-            # -u to raise error on undefined shell var (default would silently expand to empty)
-            # TODO: MC: Remove -u to avoid issues on rice with init script
-            args = ["/bin/bash", "-co", "pipefail", bash_cmd]
-            combined = dict(os.environ)     # copy existing environment for child
-            combined.update(env_overrides)  # merge in any overrides
-            combined["SHELL"] = "/bin/bash" # this var necessary in some CS110 situation?
-            combined["LC_ALL"] = "C"        # avoid curly quotes from gcc, timeout, and others
-            os.execve(args[0], args, combined)
-        except Exception:
-            # child failed to create/launch, need to tell parent what happened, but... wacky communication channel
-            # have to use child process's exitcode and output stream
-            traceback.print_exc()   # dump backtrace into child output, can be read by parent
-            sys.exit(127)           # child process exits with NO EXEC CODE to indicate failed to launch
-
-    # PARENT HERE
-    os.close(error_pipe[1])
-    os.close(status_pipe[1])
-    if not has_core_cmd: os.close(status_pipe[0])
-    util.stty_onclr(child_fd)  # disable pty's translate of LF to CRLF
-
-    starttime = time.time()
-    # read all output, read all error (special_read closes the fd once drained)
-    output = util.special_read(child_fd, max_output_len)  # child_fd contains child stdout + stderr (and tty) of core_cmd
-    # displeasing re.sub, but can't prevent timeout from generating this message when core cmd terminates uncleanly
-    if "monitored command dumped core" in output: output = re.sub("(?m)^.*monitored command dumped core.*$", "", output)
-    err_out = util.special_read(error_pipe[0], max_output_len)  # error_pipe is where bash/pipeline will report errors
-    log = util.read_file(tmpfile.name) if logged else None
-    # now wait for child to complete (timeout will kill child if needed)
-    bash_status = os.waitpid(child_pid, 0)[1]
-
-    # find any lingering grandchild processes, and kill them
-    lingering_pids = subprocess.Popen(['ps', '-s', str(child_pid), '-opid='],
-                                      stdout=subprocess.PIPE).communicate()[0].split()
-    for pid in lingering_pids:
-        subprocess.check_output(['kill', '-9', pid])
-    elapsed_time = int(math.ceil(time.time() - starttime))
-
-    bash_exitcode = os.WEXITSTATUS(bash_status) if os.WIFEXITED(bash_status) else -os.WTERMSIG(bash_status)
-    # zero exitcode means bash+entire pipeline happy
-    # if non-zero, harder to say for sure what happened
-    # -o pipefail propagates out non-zero status of any command in pipeline
-    # exitcode 1 is used by bash when command didn't parse, but also could be
-    # sign of harmless non-success if pipeline had a command that exited 1
-    # (such as a grep that didn't match anything...)
-    # if any text on stderr, assume that indicates problem otherwise try
-    # discern from exit code:
-    # accept as ok anything < 126, also ignore 141
-    # exitcode 141 means pipe closed, e.g. yes | head -- no big, just ignore
-
-    if len(err_out) or (bash_exitcode >= 126 and bash_exitcode != 141):
-        raise TestExecuteError("execute_command '%s' bash error (%d) %s" % (command, bash_exitcode, err_out if err_out else command))
-
-    if not has_core_cmd:
-        shellcode = bash_exitcode
-    else:
+                pass  # not open
+
+def kill_session(sid, spare_leader=False):
+    """Kill all processes remaining in session sid (child of pty.fork is leader of its own session).
+    Signal to the process group gets everything still in leader's group, then scan of /proc picks off
+    any that moved to a group of their own (e.g. timeout, job control in a shell). No fork/exec needed.
+    If spare_leader, kill everything except the session leader itself (only possible with /proc)."""
+    if not spare_leader:
+        try:
+            os.killpg(sid, signal.SIGKILL)
+        except OSError:
+            pass   # no process left in group
+    for pid in util.session_pids(sid) or []:
+        if spare_leader and pid == sid: continue
         try:
-            shellcode = int(util.special_read(status_pipe[0], 10))  # status_pipe has just exit code of core_cmd
-        except ValueError:
-            print("WARNING: execute_command unable to read exitcode from status_pipe")
-            shellcode = -100
-
-    # when process exited with signal, shell adds 128 to exitcode, so here
-    # remap shellcode back to -signum, i.e. shellcode 139 becomes -11 (segv)
-    if shellcode in range(128, 128 + signal.NSIG):
-        exitcode = 128 - shellcode
-    else:
-        exitcode = shellcode
-    if exitcode == -signal.SIGXCPU: exitcode = TIMED_OUT_CODE  # map XCPU to Timeout code to unify handling later
-    return util.Struct(output=output, exitcode=exitcode, time=elapsed_time, log=log)
+            os.kill(pid, signal.SIGKILL)
+        except OSError:
+            pass   # already gone
+
+def measure_overhead(ntrials=50, wd="/tmp"):
+    """Micro-benchmark of fixed per-test cost of the harness: returns average seconds from spawn
+    to result for a command that does nothing. Use to check changes to execute_command"""
+    starttime = util.monotonic()
+    for i in range(ntrials):
+        execute_command(wd, "core_cmd true", timeout=5)
+    return (util.monotonic() - starttime)/ntrials
 
 VAR_REGEX = r"(?<!\\)\$([A-Za-z0-9_]+)"
 # VAR_REGEX match $var but not \$var (will not match escaped $ due to negative lookbehind assertion)
@@ -163,6 +496,93 @@ def expand_vars(str, env):
     # for each $var in str, if var in env, replace with env[var] otherwise leave $var unchanged
     return re.sub(VAR_REGEX, lambda m: env[m.group(1)] if m.group(1) in env else m.group(0), str)
 
+class LineFilter(object):
+    """Postfilter declared as table of rules, applied to output line by line. Rules are compiled once, and each
+    rule's leading literal text (e.g. "mmap(" of r'mmap\([^,]+') is found by parsing its regex, so that for
+    most lines a cheap substring test per rule rules it out and no regex runs at all.
+    Stages are applied in order, each is tuple (kind, rules) where rules is list of (regex, replacement):
+        "line"  first rule (in list order) whose regex is found in line replaces whole line with replacement
+        "each"  every rule whose regex is found, in list order, is applied to line: replacement is re template
+                (substituted for first match) or function(match, line) returning new line
+        "all"   every match of any of the regexes anywhere in line is replaced with replacement text
+                (regexes combined into one alternation, a single re.sub pass per line)
+        "repeat" for each rule in turn, text of first match is replaced everywhere it occurs in line (str.replace,
+                so also inside longer runs, "123456 1234567" -> "<n> <n>7"), repeated until regex no longer
+                found. This is what postfilters written as while re.search/str.replace loops did
+    Instance is callable, so can be named as postfilter. Declare in sanity.py/grading.py, e.g.
+        generalize_trace = LineFilter(("line", [(r'getpid\(\)', 'getpid() = <pid>')]), ("all", [(r'0x[0-9a-f]{5,}', '<addr>')]))
+    and in manifest use postfilter = generalize_trace"""
+
+    def __init__(self, *stages):
+        self.stages = []
+        for (kind, rules) in stages:
+            assert kind in ["line", "each", "all", "repeat"], "LineFilter has unknown stage kind '%s'" % kind
+            regexes = [re.compile(regex) for (regex, repl) in rules]
+            stage = util.Struct(kind=kind, rules=[(r, leading_literal(r), repl) for (r, (regex, repl)) in zip(regexes, rules)])
+            if kind == "all":
+                stage.combined = re.compile("|".join("(?P<_rule%d>%s)" % (i, regex) for (i, (regex, repl)) in enumerate(rules)))
+            self.stages.append(stage)
+
+    def __call__(self, str):
+        return '\n'.join(self.filter_line(line) for line in str.split('\n'))
+
+    def filter_line(self, line):
+        for stage in self.stages:
+            if stage.kind == "all":
+                line = stage.combined.sub(lambda m: stage.rules[self.which(m)][2], line)
+                continue
+            for (regex, literal, repl) in stage.rules:
+                if literal not in line: continue  # can't match, skip the regex
+                m = regex.search(line)
+                if not m: continue
+                if stage.kind == "repeat":
+                    while m:
+                        line = line.replace(m.group(0), repl)
+                        m = regex.search(line)
+                    continue
+                if stage.kind == "line":
+                    line = repl
+                    break
+                line = repl(m, line) if callable(repl) else regex.sub(repl, line, 1)
+        return line
+
+    def which(self, m):
+        return next(i for i in itertools.count() if m.group("_rule%d" % i) is not None)
+
+def leading_literal(regex):
+    """Text that every match of compiled regex must start with (may be empty)"""
+    if regex.flags & (re.IGNORECASE | re.LOCALE | re.UNICODE): return ''  # literal test would be too strict
+    chars = []
+    items = list(sre_parse.parse(regex.pattern))
+    while items:
+        (op, av) = items.pop(0)
+        if op == sre_constants.LITERAL:
+            chars.append(chr(av))
+        elif op == sre_constants.SUBPATTERN and av[1]:  # group, literal continues into its contents
+            items = list(av[1]) + items
+        else:
+            break
+    return ''.join(chars)
+
+def compare_filters(filter1, filter2, outputs, repeat=3):
+    """Benchmark for changes to postfilters: applies both filters to each output (e.g. recorded program
+    outputs), returns Struct with secs1, secs2 (best of repeat, total over outputs) and mismatches (list of
+    (index of output, first line that differs) where filters don't give the same result)"""
+    def best_time(f):
+        times = []
+        for n in range(repeat):
+            starttime = util.monotonic()
+            for output in outputs: f(output)
+            times.append(util.monotonic() - starttime)
+        return min(times)
+    mismatches = []
+    for (n, output) in enumerate(outputs):
+        (result1, result2) = (filter1(output), filter2(output))
+        if result1 != result2:
+            differ = next(i for (i, pair) in enumerate(map(None, result1.split('\n'), result2.split('\n'))) if pair[0] != pair[1])
+            mismatches.append((n, differ + 1))
+    return util.Struct(secs1=best_time(filter1), secs2=best_time(filter2), mismatches=mismatches)
+
 def construct_test_from_dict(d):
     asserts.manifest("class" in d, "Test %s doesn't identify which class of test to use" % (d["name"]))
     asserts.manifest(d["class"] in globals(), "Test %s references unknown class named '%s'" % (d["name"], d["class"]))
@@ -181,6 +601,8 @@ def construct_test_from_dict(d):
 #  description = reassembles alphabet fragments given as sample
 #  timeout = 15
 #  totalpts = 4
+#  requires = 01-BuildClean, 11-Basic    (optional, skip this test unless these tests passed)
+#  kill_on_overflow = True    (optional, kill program once its output goes past the cap, result is TooMuch)
 
 class BaseTest:
 
@@ -192,8 +614,12 @@ class BaseTest:
     core_cmd_expansion = "core_cmd"
     # this list controls behavior of simple fail
     exitcodes_to_fail = [-getattr(signal, name) for name in dir(signal) if name.startswith("SIG")] + [TIMED_OUT_CODE]
+    is_barrier = False  # barrier test must run alone, after all tests before it and before all tests after it
+    can_isolate = True  # when run concurrently, ok to run in scratch workspace instead of submission itself
+    requires = []  # names of tests which must pass for this one to be worth running, see requirements()
     is_custom_template = False
     is_interactive = False
+    kill_on_overflow = False  # if True, student program is killed as soon as its output goes past the cap (manifest opts in per test)
     logged = False
     timeout = None
 
@@ -206,11 +632,17 @@ class BaseTest:
 
     def validate(self):
         asserts.manifest(hasattr(self, "timeout"), "Test %s has no timeout field" % self.name)
-        asserts.manifest(self.timeout is None or (isinstance(self.timeout, int) and self.timeout > 0), "Test %s has invalid timeout %s" % (self.name, self.timeout))
+        asserts.manifest(self.timeout is None or (isinstance(self.timeout, (int, float)) and self.timeout > 0), "Test %s has invalid timeout %s" % (self.name, self.timeout))
         asserts.manifest(not self.command or self.command.count("core_cmd") <= 1, "Test %s command has multiple occurrences of core_cmd" % self.name)
         if hasattr(self, "postfilter"):
             asserts.manifest(self.postfilter in globals(), "Test %s has postfilter '%s', no such function found (missing from grading.py file?)" % (self.name, self.postfilter))
         asserts.manifest(isinstance(self.totalpts, int), "Test %s has invalid totalpts %s" % (self.name, self.totalpts))
+        asserts.manifest(isinstance(self.requires, (basestring, list)), "Test %s has invalid requires %s" % (self.name, self.requires))
+
+    def requirements(self):
+        """Manifest can give requires as list [01-BuildClean, 11-Basic] or comma-separated 01-BuildClean, 11-Basic"""
+        reqs = self.requires.split(",") if isinstance(self.requires, basestring) else self.requires
+        return [str(r).strip() for r in reqs if str(r).strip()]
 
     def command_for_display(self, for_soln=False):
         if self.command:
@@ -231,18 +663,20 @@ class BaseTest:
         d["core_cmd"] = self.core_cmd_expansion
         return d
 
+    def announce(self, path):
+        print "\n+++ Test %s on %s" % (ui.bold(self.name), gen.shortpath(path))
+        if self.description: print "Descr:   %s" % self.description
+        if self.command: print "Command: %s" % self.command_for_display()
+
     def run(self, path, context, noisy=True, repo=None):
-        noisy = noisy and context in [FOR_AUTOGRADER, FOR_RUNTESTS, FOR_SANITY]
+        noisy = noisy and context in NOISY_CONTEXTS
         """Run the test object on the submission at the given path.  Executes
         command and scores result. Returns Result object"""
-        if noisy:
-            print "\n+++ Test %s on %s" % (ui.bold(self.name), gen.shortpath(path))
-            if self.description: print "Descr:   %s" % self.description
-            if self.command: print "Command: %s" % self.command_for_display()
+        if noisy: self.announce(path)
         try:
             r = self.execute_and_score(path, context, repo)
         except KeyboardInterrupt:  # if cntrl-c during test execution
-            if context in [FOR_SANITY, FOR_RUNTESTS, FOR_TESTSUITE, FOR_DRYRUN]: raise  # propagate up to quit
+            if context in QUIT_CONTEXTS: raise  # propagate up to quit
             r = results.Deferred()    # interrupted during batch grade, just defer the test
         r.set_test(self)  # not pretty, but lets Result obj know test information
         if noisy:
@@ -250,16 +684,18 @@ class BaseTest:
         return r
 
     def execute_local(self, wd):
-        return execute_command(wd, self.expanded_command(self.local_env()), timeout=self.timeout, logged=self.logged)
+        return execute_command(wd, self.expanded_command(self.local_env()), timeout=self.timeout, logged=self.logged, kill_on_overflow=self.kill_on_overflow)
 
     def execute_and_score(self, path, context, repo):
         """Executes command, handles simple failures (timeout, signal), filters output and passes to score.
         Can override here if need different execute+score handling, more typical to just override score"""
         student_ex = self.execute_local(path)
-        failed = self.simple_fail(student_ex)  # pick off obvious failure cases
-        if failed is not None: return failed
-        student_ex.output = self.filter(student_ex.output)
-        return self.score(student_ex, context)
+        r = self.simple_fail(student_ex)  # pick off obvious failure cases
+        if r is None:
+            student_ex.output = self.filter(student_ex.output)
+            r = self.score(student_ex, context)
+        r.usage = student_ex.usage  # record resource use of student run along with result
+        return r
 
     def score(self, student_ex, context):
         """Given student execution info, return scored result"""
@@ -273,6 +709,8 @@ class BaseTest:
         if codes_to_fail is None: codes_to_fail = self.exitcodes_to_fail
         if ex.exitcode in NO_EXEC_CODES:  # these code are always a problem, should never ignore
             return results.NoExecute(msg="(%d) %s" % (ex.exitcode, ex.output))
+        if getattr(ex, "runaway", False):  # killed for excess output, fields not set on old cached solution struct
+            return results.TooMuch(short="Output went past limit of %d chars, program was terminated" % (len(ex.output) - len("...")))
         if ex.exitcode not in codes_to_fail:
             return None
         libc_regexes = "|".join(["\*\*\* Error in `.* \*\*\*", "\*\*\* .* \*\*\*: .* terminated"])
@@ -304,6 +742,9 @@ class BaseTest:
 class VersusSolution(BaseTest):
     cache_soln_output = True
     cached_soln_ex = None
+    cached_soln_key = None
+    cached_soln_filtered = None  # filtered output of cached_soln_ex, filter once and hand same string to every compare
+    streaming = False  # spool outputs to files, score() gets only heads as output plus output_path (for huge outputs)
 
     def score(self, student_ex, soln_ex, context):
         """Given student and soln execution info, return scored result"""
@@ -315,15 +756,30 @@ class VersusSolution(BaseTest):
         Can override here if need different execute+score handling, more typical to just override score"""
         soln_ex = self.use_or_create_soln_cache(path) if self.cache_soln_output else self.execute_solution(path)
         student_ex = self.execute_local(path)
-        failed = self.simple_fail(student_ex)  # pick off obvious failure cases
-        if failed is not None: return failed
-        student_ex.output = self.filter(student_ex.output)
-        soln_ex.output = self.filter(soln_ex.output)
-        return self.score(student_ex, soln_ex, context)
+        try:
+            r = self.simple_fail(student_ex)  # pick off obvious failure cases
+            if r is None:
+                student_ex.output = self.filter(student_ex.output)
+                soln_ex.output = self.filtered_soln_output(soln_ex)
+                r = self.score(student_ex, soln_ex, context)
+        finally:
+            if getattr(student_ex, "output_path", None): util.remove_files(student_ex.output_path)
+            if getattr(soln_ex, "output_path", None) and not self.cache_soln_output: util.remove_files(soln_ex.output_path)
+        r.usage = student_ex.usage  # record resource use of student run along with result
+        return r
+
+    def filtered_soln_output(self, soln_ex):
+        if not self.cache_soln_output or soln_ex.output is not self.cached_soln_ex.output:
+            return self.filter(soln_ex.output)  # not the cached execution, nothing to reuse
+        if self.cached_soln_filtered is None or self.cached_soln_filtered[0] != self.cached_soln_key:
+            self.cached_soln_filtered = (self.cached_soln_key, self.filter(soln_ex.output))
+        return self.cached_soln_filtered[1]
 
     def execute_local(self, wd):
         solnlen = len(self.cached_soln_ex.output) if self.cached_soln_ex else -1
-        return execute_command(wd, self.expanded_command(self.local_env()), timeout=self.timeout, logged=self.logged, solnlen=solnlen)
+        if self.cached_soln_ex and getattr(self.cached_soln_ex, "output_path", None): solnlen = os.path.getsize(self.cached_soln_ex.output_path)
+        return execute_command(wd, self.expanded_command(self.local_env()), timeout=self.timeout, logged=self.logged, solnlen=solnlen,
+                               kill_on_overflow=self.kill_on_overflow, spool=self.streaming)
 
     def execute_solution(self, wd):
         # we execute the solution with working dir = submission, not sure if this is a good idea
@@ -331,9 +787,11 @@ class VersusSolution(BaseTest):
         # context for relative paths...
         #import pdb; pdb.set_trace()
         try:
-            soln_ex = execute_command(wd, self.expanded_command(self.soln_env()), timeout=self.timeout, logged=self.logged, solnlen=None)
+            soln_ex = execute_command(wd, self.expanded_command(self.soln_env()), timeout=self.timeout, logged=self.logged, solnlen=None, spool=self.streaming)
             soln_error = self.simple_fail(soln_ex)
-            if soln_error: raise Exception(soln_error.summary_string())
+            if soln_error:
+                if soln_ex.output_path: util.remove_files(soln_ex.output_path)
+                raise Exception(soln_error.summary_string())
         except Exception as e:
             # repackage as SolutionError in hopes to make it obvious to student this is our problem, not theirs
             cmd = self.command_for_display(for_soln=True)
@@ -346,41 +804,46 @@ class VersusSolution(BaseTest):
         d["core_cmd"] = self.core_cmd_expansion
         return d
 
-    def read_soln_cache(self):
-        cached_output_path = os.path.join(self.filepath, "soln_output", self.name)
-        if os.path.exists(cached_output_path):  # cached file exists, now check and see if it's up-to-date
-            try:
-                # -L means follow symlink and test on actual reference
-                # if any file in grade subdir (not subdirs) is newer than cache (rejects if any
-                # updates to manifest, solution executables, input files, and so on)
-                findcmd = "find -L %s -maxdepth 1 -cnewer %s | wc -l" % (self.filepath, cached_output_path)
-                nfiles_newer = int(commands.getstatusoutput(findcmd)[1])
-                if nfiles_newer == 0:
-                    output = util.read_file(cached_output_path)
-                    logname = "%s-%s" % (self.__class__.__name__.upper(), self.name[:2])
-                    log = util.read_file(os.path.join(self.filepath, "soln_output", logname))  # returns None if file not exist
-                    if self.logged and not log: return None  # if only have output and not log, then refresh both
-                    return util.Struct(output=output, log=log, time=-1, exitcode=0)  # JDZ faking soln time and exitcode, will this be problem?
-            except:
-                pass  # if find command fails, assume stale
-        return None
-
-    def write_soln_cache(self, ex):
-        if gen.is_instructor():  # only update cached solution file if I'm executing script (lame locking strategy)
-            if "grade" in os.path.basename(self.filepath):  # no cache output for sanity, only grade
-                cached_output_path = os.path.join(self.filepath, "soln_output", self.name)
-                util.write_file(ex.output, cached_output_path, makeparent=True)
-                if ex.log:
-                    logname = "%s-%s" % (self.__class__.__name__.upper(), self.name[:2])
-                    util.write_file(ex.log, os.path.join(self.filepath, "soln_output", logname), makeparent=True)
+    def soln_cache_key(self, wd):
+        """Digest of everything that determines solution output: postfilter and what command_key covers"""
+        return self.command_key(wd, self.soln_env(), getattr(self, "postfilter", ""), *(["streaming"] if self.streaming else []))
+
+    def command_key(self, wd, env, *extra):
+        """Digest of everything that determines outcome of command run with env: test class, expanded command,
+        extra parts, contents of executables in env and of any input file/dir named in command (relative to wd)"""
+        cmd = self.expanded_command(env)
+        parts = [self.__class__.__name__, cmd] + list(extra)
+        executables = [path for (name, path) in env.items() if name != "core_cmd"]
+        for token in sorted(set(re.split(r"[\s<>|;&()'\"=]+", cmd) + executables)):
+            digest = digests.path_digest(os.path.join(wd, token)) if token else None  # join leaves absolute path as is
+            if digest: parts += [token, digest]
+        return digests.key_for(*parts)
+
+    def soln_store(self):
+        # shared store alongside manifest, private per-user fallback in tmp if not writable (e.g. student running sanity)
+        return digests.DigestStore(os.path.join(self.filepath, "soln_output"), fallback=digests.private_tmpdir("soln_output"))
 
     def use_or_create_soln_cache(self, wd):
-        if not self.cached_soln_ex:
-            self.cached_soln_ex = self.read_soln_cache()
-            if not self.cached_soln_ex:
+        key = self.soln_cache_key(wd)  # inputs relative to wd can differ per submission, so re-check key each time
+        if not self.cached_soln_ex or key != self.cached_soln_key:
+            store = self.soln_store()
+            self.cached_soln_ex = store.get(key)
+            if self.cached_soln_ex and self.streaming:
+                self.cached_soln_ex.output_path = store.get_path(key)  # entire output is in file alongside, None if missing
+            if not self.cached_soln_ex or (self.logged and not self.cached_soln_ex.log) or (self.streaming and not self.cached_soln_ex.output_path):
                 fresh = self.execute_solution(wd)
-                self.write_soln_cache(fresh)
+                if self.streaming:
+                    try:
+                        stored = store.put_file(key, fresh.output_path)
+                    except BaseException:
+                        util.remove_files(fresh.output_path)  # else spooled temp file is left behind
+                        raise
+                    if stored:
+                        util.remove_files(fresh.output_path)
+                        fresh.output_path = stored
+                store.put(key, fresh)
                 self.cached_soln_ex = fresh
+            self.cached_soln_key = key
         # cached version has raw (unfiltered) output
         # work on a copy so filter now won't interfere with later use of cache
         return copy.copy(self.cached_soln_ex)
@@ -389,6 +852,7 @@ class BuildClean(BaseTest):
     description = "verify project builds cleanly"
     command = "make clean && make"
     timeout = None
+    is_barrier = True  # other tests depend on build products, never run concurrently with build
 
     def execute_local(self, wd):
         # JDZ to fix, consider how to jam env GCC_COLORS= ahead of make and no need to strip colors later
@@ -433,8 +897,17 @@ class ClangTidy(BuildClean):
 class OutputDiffSoln(VersusSolution):
     match_ratio = 1.0  # match_ratio is from 0 to 1 (exact match), accept when match >= ratio
     detail = None  # when set to non-empty, controls how the detail is reported (diff output/correct)
+    # set streaming for stress tests with very large output (e.g. huge feeds, disk images), outputs are compared
+    # from spooled files, stopping at first difference (exact match only, no postfilter)
+
+    def validate(self):
+        VersusSolution.validate(self)
+        if self.streaming:
+            asserts.manifest(self.match_ratio >= 1.0 and not hasattr(self, "postfilter"), "Streaming test %s cannot have match_ratio or postfilter" % self.name)
 
     def score(self, student, soln, context):
+        if self.streaming:
+            return scoring.score_output_stream(student.output_path, soln.output_path, student.output, soln.output, self.totalpts, context)
         return scoring.score_output_match(student.output, soln.output, self.totalpts, context, ratio=self.match_ratio, detail=self.detail)
 
 class GracefullyHandled(VersusSolution):
@@ -503,11 +976,29 @@ class Valgrind(WrappedWithLogFile):
     # added --trace-children=yes added so will follow through exec (i.e. env blah $hello)
     # TODO JDZ (someday/never)logging is problematic if program uses fork, need separate log files by pid, ugh
     core_cmd_expansion = "core_cmd /usr/bin/valgrind --trace-children=yes --tool=memcheck --leak-check=summary --show-reachable=yes --error-exitcode=%s --log-file=$logpath" % (VALGRIND_ERROR_CODE)
+    # xml_report = True in manifest runs memcheck with report in XML (parsed, not scraped), plain text messages discarded
+    # leak-check=full needed for leaks to be in XML, errors-for-leak-kinds=none keeps leaks from counting as errors (as summary does)
+    # not for programs that fork, child's report gets interleaved into same file and XML is malformed
+    xml_report = False
+    xml_cmd_expansion = "core_cmd /usr/bin/valgrind --trace-children=yes --tool=memcheck --leak-check=full --show-leak-kinds=all --errors-for-leak-kinds=none --error-exitcode=%s --xml=yes --xml-file=$logpath --log-file=/dev/null" % (VALGRIND_ERROR_CODE)
+
+    memoize_runs = True  # reuse outcome of earlier student run with same executables, command and inputs (see execute_local)
 
     def validate(self):
         WrappedWithLogFile.validate(self)
         asserts.manifest(isinstance(self.leakpts, int), "Valgrind test %s has invalid leakpts '%s'" % (self.name, self.leakpts))
-        self.verify_valgrind_version()
+        asserts.manifest(not self.xml_report or self.xml_cmd_expansion, "Test %s has xml_report, not supported by %s" % (self.name, self.__class__.__name__))
+        if not self.xml_report: self.verify_valgrind_version()  # XML report doesn't depend on message wording
+
+    def local_env(self):
+        d = WrappedWithLogFile.local_env(self)
+        if self.xml_report: d["core_cmd"] = self.xml_cmd_expansion
+        return d
+
+    def soln_env(self, soln_path=None):
+        d = WrappedWithLogFile.soln_env(self, soln_path)
+        if self.xml_report: d["core_cmd"] = self.xml_cmd_expansion
+        return d
 
     # We scrape the Valgrind output, so are v. sensitive to changes in text being printed, the version check
     # here will remind you to check whether a version change requires new tweaks
@@ -518,54 +1009,105 @@ class Valgrind(WrappedWithLogFile):
         output = commands.getoutput("/usr/bin/valgrind --version")
         assert(output in expected), "Valgrind version '%s' does not match expected %s." % (output, ui.pretty_list(expected))
 
+    def execute_local(self, wd):
+        """Run under valgrind is slow and its outcome is determined by what goes into the key, so an
+        unchanged submission (e.g. regrade with --update) gets the stored outcome of the earlier run instead.
+        Timeouts, runaways and no-execute are not stored, those may not happen on a re-run"""
+        if not self.memoize_runs or self.streaming: return WrappedWithLogFile.execute_local(self, wd)
+        key = self.command_key(wd, self.local_env(), self.timeout, digests.path_digest("/usr/bin/valgrind"))
+        store = digests.DigestStore(os.path.join(gen.PRIVATE_DATA_PATH, "valgrind_runs"), fallback=digests.private_tmpdir("valgrind_runs"))
+        ex = store.get(key)
+        if ex is None:
+            ex = WrappedWithLogFile.execute_local(self, wd)
+            if not ex.runaway and not isinstance(self.simple_fail(ex), (results.TimedOut, results.NoExecute)):
+                store.put(key, ex)
+        return ex
+
     def simple_fail(self, ex, codes_to_fail=None):
         """Catch weird interaction between Valgrind and certain errors. Valgrind makes special case of
         some libc aborts, writes error message into Valgind report, program terminate, exitcode 127
         (gleaned from Valgrind src: special case is buffer overflow strcpy/memcpy/memmove)"""
         # Note that we need to check for this BEFORE inherited version (which treats 127 as no execute)
         if ex.exitcode == 127 and ex.log:  # no exec yet wrote log? something is definitely up...
-            error_msg = util.match_regex("\*\*\d+\*\*\s+(.*)", ex.log)  # match line labelled **pid**
+            if self.xml_report:  # message is in report as clientmsg
+                report = scoring.parse_valgrind_xml(ex.log)
+                error_msg = report.client_msgs[0] if getattr(report, "client_msgs", None) else None
+            else:
+                error_msg = util.match_regex("\*\*\d+\*\*\s+(.*)", ex.log)  # match line labelled **pid**
             if error_msg: return results.SignalRaised(signal_string=error_msg)
         return WrappedWithLogFile.simple_fail(self, ex, codes_to_fail)
 
     def score(self, student, soln, context):
-        return scoring.score_valgrind(student.output, soln.output, self.reject_regex, student.log, student.exitcode, self.leakpts, self.totalpts - self.leakpts, context)
+        return scoring.score_valgrind(student.output, soln.output, self.reject_regex, student.log, student.exitcode, self.leakpts, self.totalpts - self.leakpts, context, self.xml_report)
 
 class MemoryUse(Valgrind):
     description = "verify reasonably efficient in use of memory"
     multiplier = 3
     leakpts = 0
     core_cmd_expansion = "core_cmd /usr/bin/valgrind --trace-children=yes --tool=memcheck --leak-check=summary --error-exitcode=%s --log-file=$logpath" % VALGRIND_ERROR_CODE
+    xml_cmd_expansion = None  # memcheck leaves heap totals out of XML report, only text has them
 
     def score(self, student, soln, context):
         return scoring.score_memory_use(student.output, soln.output, self.reject_regex, soln.log, student.exitcode, student.log, self.totalpts, self.multiplier, context)
 
 
 class Callgrind(Valgrind):
-    description = "count instructions"
-    core_cmd_expansion = "core_cmd /usr/bin/valgrind --tool=callgrind --error-exitcode=%s --log-file=$logpath" % VALGRIND_ERROR_CODE
+    description = "verify reasonably efficient in instructions executed"
+    multiplier = 3
+    top_functions = 5  # how many of most expensive functions to list in detail when over
+    # log is the callgrind.out profile (total and per-function counts), callgrind's text messages are discarded
+    core_cmd_expansion = "core_cmd /usr/bin/valgrind --tool=callgrind --error-exitcode=%s --callgrind-out-file=$logpath --log-file=/dev/null" % VALGRIND_ERROR_CODE
+    xml_cmd_expansion = None
+
+    def validate(self):
+        WrappedWithLogFile.validate(self)  # no leakpts, and profile format doesn't depend on Valgrind version
+        asserts.manifest(isinstance(self.multiplier, (int, float)) and self.multiplier > 0, "Callgrind test %s has invalid multiplier '%s'" % (self.name, self.multiplier))
+        asserts.manifest(not self.xml_report, "Test %s has xml_report, not supported by %s" % (self.name, self.__class__.__name__))
 
     def score(self, student, soln, context):
-        return scoring.score_memory_use(student.output, soln.output, self.reject_regex, soln.log, student.exitcode, student.log, self.totalpts, self.multiplier, context)
+        return scoring.score_instruction_count(student.output, soln.output, self.reject_regex, soln.log, student.exitcode, student.log, self.totalpts, self.multiplier, self.top_functions, context)
 
 
-class TimeUse(WrappedWithLogFile):
+class TimeUse(VersusSolution):
     description = "verify reasonably efficient run time performance"
     multiplier = 3
     reject_regex = None
     soln_time = None
-    core_cmd_expansion = "core_cmd /usr/bin/time -p -o $logpath"
+    # no wrapper needed, execute_command reports cpu use of core_cmd in student run (usage.utime)
+    # trials > 1 times student against solution run alternately on the spot (soln_time then only sets timeout),
+    # after warmup untimed runs of each. Ratio of aggregate ("median" of per-trial ratios or "min" time of each) is scored,
+    # but if the spread of per-trial ratios straddles multiplier the result is borderline, judged inconclusive
+    trials = 1
+    warmup = 0
+    aggregate = "median"
 
     def __init__(self, items={}):
-        WrappedWithLogFile.__init__(self, items)
+        VersusSolution.__init__(self, items)
         self.timeout = (self.multiplier+2)*self.soln_time  # slightly more generous timeout, anything past multiplier is rejected as too pokey
 
     def validate(self):
-        WrappedWithLogFile.validate(self)
-        asserts.manifest(isinstance(self.soln_time,int), "TimeUse test %s has invalid soln_time %s" % (self.name, self.soln_time))
+        VersusSolution.validate(self)
+        asserts.manifest(isinstance(self.soln_time, (int, float)) and self.soln_time > 0, "TimeUse test %s has invalid soln_time %s" % (self.name, self.soln_time))
+        asserts.manifest(isinstance(self.trials, int) and self.trials > 0, "TimeUse test %s has invalid trials %s" % (self.name, self.trials))
+        asserts.manifest(isinstance(self.warmup, int) and self.warmup >= 0, "TimeUse test %s has invalid warmup %s" % (self.name, self.warmup))
+        asserts.manifest(self.aggregate in ["median", "min"], "TimeUse test %s has invalid aggregate '%s' (median or min)" % (self.name, self.aggregate))
+
+    def execute_local(self, wd):
+        """With trials, each student run is paired with a solution run just before it, so both are timed under the
+        same machine load. Returns last student execution, with list of (student utime, soln utime) as trial_times"""
+        if self.trials <= 1: return VersusSolution.execute_local(self, wd)
+        trial_times = []
+        for i in range(self.warmup + self.trials):
+            soln_ex = self.execute_solution(wd)
+            ex = VersusSolution.execute_local(self, wd)
+            if self.simple_fail(ex): return ex  # timed out, crashed, etc. no use timing it again
+            if i >= self.warmup: trial_times.append((ex.usage.utime, soln_ex.usage.utime))
+        ex.trial_times = trial_times
+        return ex
 
     def score(self, student, soln, context):
-        return scoring.score_time_use(student.output, soln.output, student.log, self.reject_regex, student.exitcode, self.soln_time, self.totalpts, self.multiplier, context)
+        return scoring.score_time_use(student.output, soln.output, student.usage, self.reject_regex, student.exitcode, self.soln_time, self.totalpts, self.multiplier, context,
+                                      getattr(student, "trial_times", None), self.aggregate)
 
 class CustomOutputDiffSoln(OutputDiffSoln):
     # This is the test class used when students list their own cases for custom sanity check
@@ -573,10 +1115,11 @@ class CustomOutputDiffSoln(OutputDiffSoln):
     # if restrict_executables True, has to use executable named in manifest list
     # if restrict_executables False, can name their own executables (e.g. for cvec/cmap client programs)
     # for non-restricted executables, will access matching soln in student cwd instead of samples
-    # student timeout is set as 5x what the sample took
+    # student timeout is set as 5x what the sample took (but never less than MIN_TIMEOUT)
     is_custom_template = True
     restrict_executables = True
     timeout = None
+    MIN_TIMEOUT = 0.5  # seconds, floor keeps process startup jitter from timing out a fast custom test
 
     def init_from_string(self, line, num):
         self.name = "Custom-%d" % num
@@ -606,14 +1149,15 @@ class CustomOutputDiffSoln(OutputDiffSoln):
     def soln_env(self):
         return OutputDiffSoln.soln_env(self, soln_path=self.soln_path)
 
-    def execute_solution(self, wd):
+    def use_or_create_soln_cache(self, wd):
         self.timeout = None  # temporarily set timeout to let solution run to completion
-        soln_ex = OutputDiffSoln.execute_solution(self, wd)
-        self.timeout = 5*soln_ex.time  # set timeout to be 5x what solution took
+        soln_ex = OutputDiffSoln.use_or_create_soln_cache(self, wd)  # cached ex records time solution took
+        self.timeout = max(self.MIN_TIMEOUT, 5*soln_ex.time)  # set timeout to be 5x what solution took
         return soln_ex
 
 class GraderReview(BaseTest):
     is_interactive = True
+    can_isolate = False  # reads/writes WEB_REVIEW in the submission itself
     description = "grader review of submission"
 
     def __init__(self, items={}):
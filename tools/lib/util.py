@@ -7,7 +7,7 @@ The util module defines features that have general-purpose use.
 Avoid imports of other modules, esp. not gen (because gen imports util)
 """
 
-import commands, ConfigParser, datetime, errno, getopt, operator, os, re, shutil, smtplib, sys, tempfile, termios, time
+import commands, ConfigParser, datetime, errno, getopt, operator, os, Queue, re, shutil, smtplib, sys, tempfile, termios, threading, time
 from common import *
 
 class Struct(object):
@@ -134,30 +134,99 @@ def stty_onclr(fd):
 def unbuffer_stdout():
     sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
 
-def special_read(fd, truncate_len):
-    '''Used only in execute_command to read the pipe with command results.
+def _monotonic_clock():
+    """Python 2 time module has no monotonic clock, reach clock_gettime(CLOCK_MONOTONIC) through ctypes.
+    Unaffected by adjustments to wall clock, resolution in nanoseconds. Falls back to time.time if unavailable"""
+    if hasattr(time, "monotonic"): return time.monotonic
+    try:
+        import ctypes, ctypes.util
+        class timespec(ctypes.Structure):
+            _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+        lib = ctypes.CDLL(ctypes.util.find_library("rt") or ctypes.util.find_library("c"), use_errno=True)
+        clock_gettime = lib.clock_gettime
+        clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+        CLOCK_MONOTONIC = 1  # from <linux/time.h>
+        def monotonic():
+            ts = timespec()
+            if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+                raise OSError(ctypes.get_errno(), "clock_gettime failed")
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+        monotonic()  # verify it works here before committing to it
+        return monotonic
+    except Exception:
+        return time.time
+
+monotonic = _monotonic_clock()  # seconds (float) since arbitrary fixed point, use only for differences
+
+READ_SIZE = 64*1024  # bytes per os.read when draining command output
+SPOOL_HEAD = 64*1024  # chars of output kept in memory by a spooling Capture
+
+class Capture(object):
+    '''Accumulates what is read from one fd of command being executed (by testing.Execution), one read
+    at a time so that reads of several fds can be interleaved (see testing.drive).
     Has some special quirks/conveniences for this specific situation.
-    1) read and discard all content after hitting truncate_len
+    1) keep first truncate_len chars, read and discard all content after that. If on_overflow
+       given, it is called (once) when output first goes past truncate_len, e.g. to kill runaway writer
     2) EOF usually signaled by read returning empty but if reading from tty, treat OSError as EOF
        (necessary for linux version of pty)
-    3) remove trailing newline from output'''
-    buf = ''
-    did_discard = False
-    while True:
+    3) remove trailing newline from output
+    4) if spool file given, all kept content is written there and only the first SPOOL_HEAD chars are
+       kept in memory, value() is then just the head (for huge outputs compared from file, see scoring.first_divergence)
+    Reads are gathered as list of large chunks and joined once at end, cost is linear in output size'''
+
+    def __init__(self, fd, truncate_len, on_overflow=None, spool=None):
+        self.fd = fd
+        self.truncate_len = truncate_len
+        self.on_overflow = on_overflow
+        self.spool = spool
+        self.chunks = []
+        self.nkept = self.nread = 0
+        self.did_discard = False
+        self.eof = False
+
+    def read_some(self):
+        '''One read of whatever is available (blocks if nothing is). Returns False once at EOF, fd is then closed'''
         try:
-            cur = os.read(fd, 1024)  # use os.read (less buggy than python File)
-            if cur == "": break   # EOF returns empty (expected behavior)
-            if len(buf) < truncate_len:
-                buf += cur
-            else:
-                did_discard = True
+            cur = os.read(self.fd, READ_SIZE)  # use os.read (less buggy than python File)
         except OSError:
-            if os.isatty(fd): break  # EOF for pty raises error, swallow it (http://bugs.python.org/issue5380)
-            raise                 # otherwise re-raise actual error
-    os.close(fd)
-    if did_discard: buf = buf[:truncate_len] + "..."
-    if buf and buf[-1] == '\n': buf = buf[:-1]  # ugh, remove trailing newline if present
-    return buf
+            if not os.isatty(self.fd): raise  # re-raise actual error
+            cur = ""   # EOF for pty raises error, swallow it (http://bugs.python.org/issue5380)
+        if cur == "":  # EOF returns empty (expected behavior)
+            os.close(self.fd)
+            self.eof = True
+            return False
+        self.nread += len(cur)
+        if self.nkept < self.truncate_len:
+            if self.spool: self.spool.write(cur[:self.truncate_len - self.nkept])
+            if not self.spool or self.nkept < SPOOL_HEAD: self.chunks.append(cur)
+            self.nkept += len(cur)
+        if self.nread > self.truncate_len and not self.did_discard:
+            self.did_discard = True
+            if self.on_overflow: self.on_overflow()
+        return True
+
+    def value(self):
+        buf = "".join(self.chunks)
+        limit = min(self.truncate_len, SPOOL_HEAD) if self.spool else self.truncate_len
+        if self.did_discard or len(buf) > limit: buf = buf[:limit] + "..."
+        if buf and buf[-1] == '\n': buf = buf[:-1]  # ugh, remove trailing newline if present
+        return buf
+
+def session_pids(sid):
+    """Returns list of pids for live processes in session sid, found by scanning /proc directly
+    (cheaper and less racy than fork/exec of ps). Returns None if system has no /proc"""
+    if not os.path.isdir("/proc/self"): return None
+    pids = []
+    for name in os.listdir("/proc"):
+        if not name.isdigit(): continue
+        try:
+            with open("/proc/%s/stat" % name) as fp:
+                # stat is "pid (comm) state ppid pgrp session ...", comm can contain spaces/parens so split after last paren
+                fields = fp.read().rsplit(")", 1)[1].split()
+        except (IOError, IndexError):
+            continue   # process exited while we were scanning
+        if int(fields[3]) == sid: pids.append(int(name))
+    return pids
 
 def samefile(p1, p2):
     # os.path.samefile raises exception if either path doesn't exist, this version returns False
@@ -396,3 +465,81 @@ class LockedFile(object):
     def __del__(self):
         if self.file is not None: self.file.close()
         if self.lockfd != -1: self.unlock()
+
+class WorkerPool(object):
+    """Runs calls on a fixed number of worker threads. Threads (not processes) are a fine fit for
+    the test harness because a worker spends nearly all of its time blocked waiting on a child process.
+    Submit (key, fn, args) and collect outcomes with next_finished() in the order they complete."""
+    POLL = 0.25  # Seconds between checks, keeps wait in main thread interruptible by control-C
+
+    def __init__(self, nworkers):
+        self.nworkers = max(1, nworkers)
+        self.pending = Queue.Queue()
+        self.finished = Queue.Queue()
+        self.threads = []
+        self.outstanding = 0
+        self.abandoned = set()
+        self.running = {}  # key -> thread, for calls in progress
+
+    def submit(self, key, fn, *args):
+        self.outstanding += 1
+        self.pending.put((key, fn, args))
+        if len(self.threads) < self.nworkers:  # start threads lazily, never more than needed
+            t = threading.Thread(target=self._work)
+            t.daemon = True   # abandoned workers will not hold up exit of main thread
+            t.start()
+            self.threads.append(t)
+
+    def _work(self):
+        while True:
+            job = self.pending.get()
+            if job is None: return  # sentinel from shutdown
+            (key, fn, args) = job
+            self.running[key] = threading.current_thread()
+            try:
+                self.finished.put((key, fn(*args), None))
+            except BaseException:
+                self.finished.put((key, None, sys.exc_info()))  # hand exception back to main thread to re-raise
+            finally:
+                self.running.pop(key, None)
+
+    def next_finished(self, timeout=None):
+        """Returns tuple (key, value, exc_info) for next completed call, exc_info is None unless call raised.
+        Blocks until a call completes, returns None if timeout (in seconds) expires first"""
+        deadline = monotonic() + timeout if timeout is not None else None
+        while True:
+            wait = self.POLL if deadline is None else min(self.POLL, max(0, deadline - monotonic()))
+            try:
+                outcome = self.finished.get(True, wait)
+                if outcome[0] in self.abandoned:
+                    self.abandoned.remove(outcome[0])
+                    continue
+                self.outstanding -= 1
+                return outcome
+            except Queue.Empty:
+                if deadline is not None and monotonic() >= deadline: return None
+
+    def has_outstanding(self):
+        return self.outstanding > 0
+
+    def abandon(self, key):
+        """Give up on call submitted with key that is stuck in a worker (threads can't be killed). One more
+        worker is allowed to stand in for the stuck one. If the call ever does complete, its outcome is discarded"""
+        self.abandoned.add(key)
+        self.nworkers += 1
+        self.outstanding -= 1
+
+    def shutdown(self):
+        """Stops the workers: calls not yet started are dropped, one sentinel per worker ends its loop once its
+        current call returns, then waits for workers to exit (except those stuck in an abandoned call)"""
+        try:
+            while True: self.pending.get_nowait()
+        except Queue.Empty:
+            pass
+        stuck = set(self.running.get(key) for key in self.abandoned)
+        for t in self.threads:
+            self.pending.put(None)
+        for t in self.threads:
+            while t.is_alive() and t not in stuck:
+                t.join(self.POLL)  # join with timeout, keeps wait interruptible by control-C
+        self.threads = []
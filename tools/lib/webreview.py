@@ -8,10 +8,17 @@ grader's scores/comments.
 A grader review is stored as a pickle file named WEB_REVIEW
 """
 
-import cPickle, glob, os
+import cPickle, glob, os, threading
 import course, ui, util
 from common import *
 
+_loaded = {}  # picklepath -> (stat signature, WebReview), load hands out same object until file changes
+_loaded_lock = threading.Lock()
+
+def file_signature(path):
+    st = os.stat(path)
+    return (st.st_mtime, st.st_size, st.st_ino)  # save renames new file into place, so inode changes even within same mtime tick
+
 class WebReview(object):
     MANIFEST_FILENAME = "WEB_REVIEW.ini"
     REVIEW_FILENAME = "WEB_REVIEW"
@@ -105,6 +112,13 @@ class WebReview(object):
         with open(tmpfile, "w") as fp:
             cPickle.dump(self, fp)
         os.rename(tmpfile, self.writeback_path)  # atomic save, just in case
+        with _loaded_lock:
+            _loaded[self.writeback_path] = (file_signature(self.writeback_path), self)
+
+    def forget(self):
+        """Drop from load's cache, e.g. after edits that won't be saved"""
+        with _loaded_lock:
+            if _loaded.get(self.writeback_path, (None, None))[1] is self: del _loaded[self.writeback_path]
 
     def matched_files(self, repo_path, patterns):
         globbed = sum((glob.glob("%s/%s" % (repo_path, f)) for f in patterns), [])
@@ -141,13 +155,20 @@ class WebReview(object):
 
     @classmethod
     def load(cls, path):
-        """Try read cached object from pickle file"""
+        """Try read cached object from pickle file. Unpickled object is kept and handed out again
+        on later loads of same path, as long as file is unchanged (same mtime, size, inode)"""
         picklepath = os.path.join(path, cls.REVIEW_FILENAME)
         if os.access(picklepath, os.R_OK):
+            sig = file_signature(picklepath)
+            with _loaded_lock:
+                loaded = _loaded.get(picklepath)
+            if loaded and loaded[0] == sig: return loaded[1]
             with open(picklepath) as f:
                 wr = cPickle.load(f)
             # unarchived web review needs path being read from, path not stored in pickle
             wr.writeback_path = picklepath
+            with _loaded_lock:
+                _loaded[picklepath] = (sig, wr)
             return wr
         return None
 
@@ -191,6 +212,7 @@ class WebReview(object):
             wr.overview = overview
         except KeyboardInterrupt:  # ^C allows grader to defer dealing with this one now, no changes saved
             print " *** Grader canceled *** "
+            wr.forget()  # partly edited object is the one load hands out, drop it so next load re-reads file
             return False
         wr.save()
         return True
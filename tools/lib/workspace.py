@@ -0,0 +1,155 @@
+"""
+Scratch copies of a submission, so that tests on the same repo can run concurrently
+without their scratch files (make targets, cache dirs, output files) colliding.
+
+The submission is copied into a base snapshot, each test then gets a workspace cloned from
+the base. Files anyone can write are copied, so a test that writes into a file in place changes
+only its own copy, never the base or a workspace of a test running alongside. Only read-only
+files (no write permission for anyone) are hard-linked from the base, sharing their data
+(running as root, when permissions stop nothing, every file is copied). After a barrier (e.g.
+build) the base is refreshed, only files that changed since the last snapshot are copied again,
+the rest of the build tree stays as it is. A workspace goes back to the idle list after its test
+and is reused as-is if its test left it unchanged, otherwise it is re-cloned. Should a test get
+at a linked file anyway (e.g. chmod then write), the base is checked by signature when that
+workspace is released and restored for later tests. Everything lives under one temp dir
+removed in bulk at cleanup.
+"""
+
+import os, shutil, stat, tempfile, threading
+
+IGNORE = shutil.ignore_patterns(".git")  # tests never look at repo history, skip copying it
+
+class Workspaces(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.root = tempfile.mkdtemp(prefix="workspaces-")
+        self.base = os.path.join(self.root, "base")
+        self.copied = {}    # base file path -> (stat of submission file, stat of base copy) when copied
+        self.idle = []      # list of (path, is_dirty) for workspaces not in use
+        self.pristine = {}  # path -> signature of workspace as freshly cloned
+        self.count = 0
+        self.lock = threading.Lock()  # acquire/release are called from worker threads
+        self.base_lock = threading.RLock()  # held while base is cloned, checked or refreshed
+        try:
+            self.refresh()
+        except Exception:
+            self.cleanup()
+            raise
+
+    def ignore(self, dirpath, names):
+        # never copy our own root into base (happens if submission path contains the temp dir)
+        own = [os.path.basename(self.root)] if os.path.realpath(dirpath) == os.path.dirname(os.path.realpath(self.root)) else []
+        return IGNORE(dirpath, names).union(own)
+
+    def refresh(self):
+        """Brings base up to date with submission (call after anything that may change it, e.g. a build),
+        copying only files changed since they were last copied. Idle workspaces cloned from an older base are re-cloned"""
+        with self.base_lock:
+            changed = sync_tree(self.path, self.base, self.copied, self.ignore)
+            self.base_signature = signature(self.base)
+        if changed:
+            with self.lock:
+                self.idle = [(path, True) for (path, dirty) in self.idle]
+
+    def acquire(self):
+        """Returns path to workspace with pristine clone of submission, for exclusive use until released"""
+        with self.lock:
+            (path, dirty) = self.idle.pop() if self.idle else (None, True)
+        if not dirty: return path  # untouched by last test, reuse as is
+        if path: shutil.rmtree(path, ignore_errors=True)
+        if not path or os.path.exists(path):  # (couldn't entirely remove, leave remnant for cleanup)
+            with self.lock:
+                self.count += 1
+                path = os.path.join(self.root, "ws%d" % self.count)
+        with self.base_lock:
+            clone_tree(self.base, path)
+        self.pristine[path] = signature(path)
+        return path
+
+    def release(self, path):
+        dirty = signature(path) != self.pristine[path]
+        with self.lock:
+            self.idle.append((path, dirty))
+        if dirty:  # if test got to a linked file (shared inode with base), base changed with it
+            with self.base_lock:
+                if signature(self.base) != self.base_signature: self.refresh()
+
+    def cleanup(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+
+
+def file_stat(path):
+    st = os.lstat(path)
+    return (st.st_mode, st.st_size, st.st_mtime, st.st_ino)
+
+def remove_path(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+def sync_tree(src, dst, copied, ignore):
+    """Makes dst a copy of src (symlinks copied as links, ignore as for shutil.copytree). A regular file is copied
+    only if neither it nor its copy in dst has changed (by stat) since the copy recorded in copied (dst path -> stats),
+    a file is never rewritten in place (removed, then copied anew) as workspaces may have links to it.
+    Returns True if anything in dst was changed"""
+    changed = False
+    if not os.path.isdir(dst) or os.path.islink(dst):
+        if os.path.lexists(dst): remove_path(dst)
+        os.mkdir(dst)
+        changed = True
+    names = os.listdir(src)
+    names = [name for name in names if name not in ignore(src, names)]
+    for name in set(os.listdir(dst)) - set(names):
+        remove_path(os.path.join(dst, name))
+        changed = True
+    for name in names:
+        (s, d) = (os.path.join(src, name), os.path.join(dst, name))
+        if os.path.islink(s):
+            if os.path.islink(d) and os.readlink(d) == os.readlink(s): continue
+            if os.path.lexists(d): remove_path(d)
+            os.symlink(os.readlink(s), d)
+            changed = True
+        elif os.path.isdir(s):
+            changed = sync_tree(s, d, copied, ignore) or changed
+        elif os.path.isfile(s):  # (fifo, socket, device never copied)
+            source = file_stat(s)
+            record = copied.get(d)
+            if record and record[0] == source and os.path.lexists(d) and file_stat(d) == record[1]: continue
+            if os.path.lexists(d): remove_path(d)
+            shutil.copy2(s, d)
+            copied[d] = (source, file_stat(d))
+            changed = True
+    return changed
+
+WRITABLE = stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH
+
+def clone_tree(src, dst, link_ok=None):
+    """Recreate directories of src at dst, copy symlinks, copy regular files that are writable (by anyone, or any
+    file at all if running as root), hard-link the rest (like cp -al), as a link would share writes in place"""
+    if link_ok is None: link_ok = os.geteuid() != 0
+    os.mkdir(dst)
+    for name in os.listdir(src):
+        (s, d) = (os.path.join(src, name), os.path.join(dst, name))
+        mode = os.lstat(s).st_mode
+        if stat.S_ISLNK(mode):
+            os.symlink(os.readlink(s), d)
+        elif stat.S_ISDIR(mode):
+            clone_tree(s, d, link_ok)
+        elif link_ok and not mode & WRITABLE:
+            os.link(s, d)
+        else:
+            shutil.copy2(s, d)
+
+def signature(path):
+    """Summary of tree that changes if test created/removed/renamed anything (directory listings and mtimes)
+    or changed a file's mode/contents. Stat only, no reads. Link count/ctime excluded, those change
+    on shared inodes whenever another workspace is cloned"""
+    sig = []
+    for (dirpath, dirnames, filenames) in os.walk(path):
+        sig.append((dirpath, os.lstat(dirpath).st_mtime, sorted(dirnames + filenames)))
+        for name in filenames:
+            st = os.lstat(os.path.join(dirpath, name))
+            sig.append((name, st.st_mode, st.st_mtime, st.st_size))
+    return sig